@@ -0,0 +1,116 @@
+# Files the generated experiment loads: images (and later audio)
+
+import base64
+import hashlib
+import json
+from pathlib import Path
+
+from output import atomic_write
+
+# Written before jsPsych.init when there are images. These Image objects are
+# what the sketchpad code draws; an image still loading or decoding (even
+# from a data: URL) is drawn as nothing, so jspsych_load_images decodes them
+# all before the experiment starts.
+IMAGES_JS = """\
+var jspsych_images = {};
+function jspsych_image(src) {
+    if (!(src in jspsych_images)) {
+        jspsych_images[src] = new Image();
+        jspsych_images[src].src = src;
+    }
+    return jspsych_images[src];
+}
+function jspsych_load_images(urls) {
+    return Promise.all(urls.map(function (src) {
+        return jspsych_image(src).decode().catch(function () {
+            throw new Error("Could not load " + src);
+        });
+    }));
+}
+
+"""
+
+class AssetManifest:
+    """
+    Collects the assets used while translating. With an output_dir, each is
+    copied to output_dir/assets under a name including a hash of its
+    contents, so browsers can cache it indefinitely and a changed file
+    always gets a new URL. Without one, assets are referred to by the name
+    they were given and copying them is left to the user.
+    """
+    def __init__(self, output_dir=None):
+        self.output_dir = None if output_dir is None else Path(output_dir)
+        # source path: URL
+        self._urls = {}
+        # kind ("image", "audio"): URLs in the order added
+        self.urls_by_kind = {}
+
+    def add_file(self, source, name, kind="image"):
+        """
+        source: path of the file, name: how the experiment refers to it.
+        Returns the URL to load it from.
+        """
+        source = str(source)
+        url = self._urls.get(source)
+        if url is None:
+            if self.output_dir is None:
+                url = name
+            else:
+                with open(source, "rb") as f:
+                    url = self.store(Path(name), f.read())
+            self._urls[source] = url
+            self.urls_by_kind.setdefault(kind, [])
+            if url not in self.urls_by_kind[kind]:
+                self.urls_by_kind[kind].append(url)
+        return url
+
+    def add_generated(self, name, content, kind="image"):
+        """
+        Adds a file made during translation (e.g. a rendered patch).
+        Without an output_dir it is embedded as a data: URL.
+        Returns the URL.
+        """
+        if self.output_dir is None:
+            encoded = base64.b64encode(content).decode("ascii")
+            url = f"data:{kind}/{Path(name).suffix[1:]};base64,{encoded}"
+        else:
+            url = self.store(Path(name), content)
+        self.urls_by_kind.setdefault(kind, [])
+        if url not in self.urls_by_kind[kind]:
+            self.urls_by_kind[kind].append(url)
+        return url
+
+    def store(self, name, content):
+        """
+        Writes content to output_dir/assets under a content-hashed version
+        of name, unless already there. Returns the URL.
+        """
+        digest = hashlib.sha1(content).hexdigest()[:12]
+        filename = f"{name.stem}.{digest}{name.suffix}"
+        asset_dir = self.output_dir / "assets"
+        asset_dir.mkdir(parents=True, exist_ok=True)
+        path = asset_dir / filename
+        if not path.exists():
+            # never a partly written file under the final name, as that
+            # would be taken as complete next time
+            with atomic_write(path, "wb") as f:
+                f.write(content)
+        return f"assets/{filename}"
+
+    def urls(self, kind):
+        return self.urls_by_kind.get(kind, [])
+
+    def preload_urls(self, kind):
+        # for the page to fetch early; data: URLs are in it already, though
+        # they still need decoding (see IMAGES_JS)
+        return [url for url in self.urls(kind) if not url.startswith("data:")]
+
+    def preload_js(self):
+        """
+        jsPsych.init parameters to preload everything, as lines of JS
+        """
+        lines = []
+        for kind, param in (("image", "preload_images"), ("audio", "preload_audio")):
+            if self.preload_urls(kind):
+                lines.append(f"{param}: {json.dumps(self.preload_urls(kind))}")
+        return lines
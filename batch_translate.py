@@ -0,0 +1,139 @@
+"""
+Translate OpenSesame experiment files to jsPsych without the GUI, e.g.
+
+    python batch_translate.py -o out experiments/*.osexp
+
+Each experiment goes to its own directory (named after the file) under the
+output directory. Needs libopensesame, but not Qt.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+from pathlib import Path
+import sys
+import time
+import traceback
+
+def load_experiment(path):
+    from libopensesame.experiment import experiment
+    return experiment(string=str(path), experiment_path=str(path.parent))
+
+def translate_file(path, output_dir, options, zip_output=False):
+    """
+    Runs in a worker process. Files whose contents haven't changed are
+    left alone; with zip_output, the directory is also archived alongside.
+    Returns (path, seconds taken, summary of files written or None,
+    traceback text or None)
+    """
+    start_time = time.perf_counter()
+    try:
+        from opensesame_to_jspsych import Convertor
+        from output import OutputDirectory
+        output = OutputDirectory(output_dir)
+        # nothing else refers to the experiment, so with compact_tables its
+        # tables can be released as they are copied, and the rest freed
+        # before the JS is written
+        convertor = Convertor(
+            load_experiment(path), owns_experiment=True,
+            output_dir=output_dir, **options
+        )
+        with output.open("experiment.js") as f:
+            html, _ = convertor.to_jspsych(f)
+        output.write_text("experiment.html", html)
+        # only now that nothing refers to old tables
+        output.prune("tables", convertor.context.table_files)
+        if zip_output:
+            output.zip()
+    except Exception:
+        return path, time.perf_counter() - start_time, None, traceback.format_exc()
+    return path, time.perf_counter() - start_time, output.summary(), None
+
+def output_dirs(paths, output_root):
+    dirs = {}
+    for path in paths:
+        out = output_root / path.stem
+        if out in dirs.values():
+            raise Exception(f"More than one experiment would be written to {out}")
+        dirs[path] = out
+    return dirs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Translate OpenSesame experiments to jsPsych"
+    )
+    parser.add_argument("experiments", nargs="+", type=Path,
+        help=".osexp files to translate")
+    parser.add_argument("-o", "--output", type=Path, default=Path("out"),
+        help="directory to write one subdirectory per experiment to")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+        help="number of worker processes (default: one per core)")
+    parser.add_argument("--columnar-tables", action="store_true",
+        help="write loop tables column by column")
+    parser.add_argument("--external-tables", action="store_true",
+        help="write loop tables to separate files")
+    parser.add_argument("--compress-tables", action="store_true",
+        help="gzip external loop tables")
+    parser.add_argument("--prerender-sketchpads", action="store_true",
+        help="draw sketchpads without variables once, at startup")
+    parser.add_argument("--optimize", action="store_true",
+        help="leave out never-run items and unused or constant loop columns")
+    parser.add_argument("--telemetry", action="store_true",
+        help="record presentation timing and dropped frames in the trial data")
+    parser.add_argument("--bundle", action="store_true",
+        help="load jsPsych, the plugins and the experiment as one minified file")
+    parser.add_argument("--jspsych-dir", type=Path, default=None,
+        help="jsPsych to bundle (default: external/jspsych in each output directory)")
+    parser.add_argument("--compact-tables", action="store_true",
+        help="copy loop tables to compact arrays, freeing the experiment sooner")
+    parser.add_argument("--zip", action="store_true",
+        help="also archive each experiment's directory to a .zip alongside it")
+    parser.add_argument("--patch-cache-dir", type=Path, default=None,
+        help="keep rendered gabor and noise patches here between runs")
+    args = parser.parse_args(argv)
+    options = {
+        "columnar_tables": args.columnar_tables,
+        "external_tables": args.external_tables,
+        "compress_tables": args.compress_tables,
+        "prerender_sketchpads": args.prerender_sketchpads,
+        "patch_cache_dir": args.patch_cache_dir,
+        "optimize": args.optimize,
+        "telemetry": args.telemetry,
+        "bundle": args.bundle,
+        "jspsych_dir": args.jspsych_dir,
+        "compact_tables": args.compact_tables,
+    }
+    dirs = output_dirs(args.experiments, args.output)
+
+    failures = []
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(translate_file, path, dirs[path], options, args.zip): path
+            for path in args.experiments
+        }
+        for future in as_completed(futures):
+            try:
+                path, seconds, summary, error = future.result()
+            except Exception:
+                # the worker itself died
+                path, seconds, summary, error = (
+                    futures[future], 0, None, traceback.format_exc()
+                )
+            if error is None:
+                print(f"ok    {seconds:7.2f}s  {path} -> {dirs[path]} ({summary})")
+            else:
+                print(f"FAIL  {seconds:7.2f}s  {path}")
+                failures.append((path, error))
+    total = time.perf_counter() - start_time
+
+    for path, error in failures:
+        print(f"\n----- {path} -----\n{error}", file=sys.stderr)
+    print(
+        f"\n{len(args.experiments) - len(failures)} translated, "
+        f"{len(failures)} failed, in {total:.2f}s"
+    )
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+Times translating again with a TranslationCache, as the extension and
+preview.py do after each edit: with no cache, the first time with one,
+again with nothing changed, after changing one sketchpad and after then
+changing one keyboard response.
+
+    python benchmarks/cache_benchmark.py
+
+As in the extension, each translation is given item_hashes from a snapshot
+of the experiment's script. "snapshot" is how long taking that
+(experiment.to_string()) takes; it is needed anyway so the experiment can
+be translated while it is being edited.
+"""
+
+import argparse
+from pathlib import Path
+import sys
+import time
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE))
+sys.path.insert(0, str(HERE.parent))
+
+from generators import CASES
+from opensesame_to_jspsych import Convertor
+from translation_cache import TranslationCache, script_hashes
+
+def translate(experiment, cache):
+    item_hashes = None
+    if cache is not None:
+        item_hashes = script_hashes(experiment.to_string())
+    start_time = time.perf_counter()
+    html, js = Convertor(
+        experiment, cache=cache, item_hashes=item_hashes
+    ).to_jspsych()
+    return time.perf_counter() - start_time, html + js
+
+def middle(experiment, type_name):
+    items = [
+        item for item in experiment.items.values()
+        if type(item).__name__ == type_name
+    ]
+    return items[len(items) // 2]
+
+def edit_sketchpad(experiment):
+    """
+    Changes a sketchpad half way through the experiment
+    """
+    element = middle(experiment, "sketchpad").elements[0]
+    element.properties["color"] = "blue"
+
+def edit_keyboard(experiment):
+    """
+    Changes a keyboard response half way through the experiment
+    """
+    middle(experiment, "keyboard_response").var.allowed_responses = "z;m;space"
+
+EDITS = {"sketchpad edit": edit_sketchpad, "keyboard edit": edit_keyboard}
+
+def measure(generator, argument, repeat):
+    """
+    Fastest of repeat runs of each, in seconds
+    """
+    results = {}
+    for _ in range(repeat):
+        experiment = generator(argument)
+        cache = TranslationCache()
+        times = {}
+        times["no cache"], expected = translate(experiment, None)
+        times["first"], js = translate(experiment, cache)
+        assert js == expected
+        times["unchanged"], js = translate(experiment, cache)
+        assert js == expected
+        for name, edit in EDITS.items():
+            edit(experiment)
+            _, expected = translate(experiment, None)
+            times[name], js = translate(experiment, cache)
+            assert js == expected
+        start_time = time.perf_counter()
+        experiment.to_string()
+        times["snapshot"] = time.perf_counter() - start_time
+        for name, seconds in times.items():
+            results[name] = min(results.get(name, seconds), seconds)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Translation cache timings")
+    parser.add_argument("--only", nargs="*", default=None,
+        help="case names to run (default all)")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="runs per case, the fastest is kept")
+    args = parser.parse_args(argv)
+
+    for name, (generator, argument) in CASES.items():
+        if args.only is not None and name not in args.only:
+            continue
+        results = measure(generator, argument, args.repeat)
+        print(f"{name:24} " + "  ".join(
+            f"{measurement} {seconds:7.3f}s"
+            for measurement, seconds in results.items()
+        ))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Synthetic experiments of different shapes, built from standins
+"""
+
+from standins import (
+    DataMatrix, Experiment, keyboard_response, line, loop, notepad, rect,
+    sequence, sketchpad, textline
+)
+
+def trial_items(prefix, text="+", duration="keypress"):
+    """
+    A sketchpad and keyboard response, as in most trials
+    """
+    return [
+        sketchpad(f"{prefix}_sketchpad", [textline(text=text)], duration=duration),
+        keyboard_response(f"{prefix}_keyboard", allowed_responses="z;m"),
+    ]
+
+def deep_nesting(depth):
+    """
+    depth sequences, each containing the next, with a trial at the bottom
+    """
+    items = trial_items("trial")
+    inner = [(item.name, "always") for item in items]
+    for level in reversed(range(depth)):
+        seq = sequence(f"sequence_{level}", inner)
+        items.append(seq)
+        inner = [(seq.name, "always")]
+    return Experiment(items, "sequence_0")
+
+def deep_loops(depth):
+    """
+    depth loops, each looping over the next, with a trial at the bottom
+    using the innermost loop's variable
+    """
+    items = trial_items("trial", text="[level]")
+    inner = sequence("trial_sequence", [(item.name, "always") for item in items])
+    items.append(inner)
+    for level in reversed(range(depth)):
+        inner = loop(f"loop_{level}", inner.name, DataMatrix({"level": [level]}))
+        items.append(inner)
+    seq = sequence("experiment", [(inner.name, "always")])
+    return Experiment(items + [seq], "experiment")
+
+def wide_sequence(width):
+    """
+    One sequence of width trials, with a note every ten
+    """
+    items = []
+    for idx in range(width):
+        items += trial_items(f"trial_{idx}", text=f"Trial {idx}", duration="500")
+        if idx % 10 == 0:
+            items.append(notepad(f"note_{idx}", note=f"Block {idx // 10}"))
+    seq = sequence("experiment", [(item.name, "always") for item in items])
+    return Experiment(items + [seq], "experiment")
+
+def huge_loop(rows, columns=6):
+    """
+    A loop over a rows x columns table, the trial using some of the columns
+    """
+    table = {"duration": [500 + (row % 4) * 100 for row in range(rows)]}
+    for col in range(1, columns):
+        table[f"factor_{col}"] = [f"level_{row % (col + 2)}" for row in range(rows)]
+    items = trial_items("trial", duration="[duration]")
+    items[0].elements.append(textline(text="[factor_1]"))
+    trial_seq = sequence("trial_sequence", [(item.name, "always") for item in items])
+    block = loop("block_loop", trial_seq.name, DataMatrix(table))
+    seq = sequence("experiment", [(block.name, "always")])
+    return Experiment(items + [trial_seq, block, seq], "experiment")
+
+def element_heavy(elements):
+    """
+    One sketchpad with this many elements, cycling through lines, rectangles
+    and text
+    """
+    shapes = []
+    for idx in range(elements):
+        colour = ["white", "red", "green"][(idx // 10) % 3]
+        if idx % 3 == 0:
+            shapes.append(line(x1=idx, y1=0, x2=idx, y2=100, color=colour))
+        elif idx % 3 == 1:
+            shapes.append(rect(x=idx, y=idx, w=10, h=10, color=colour))
+        else:
+            shapes.append(textline(text=f"t{idx}", x=idx, y=-idx, color=colour))
+    items = [
+        sketchpad("display", shapes),
+        keyboard_response("response"),
+    ]
+    seq = sequence("experiment", [(item.name, "always") for item in items])
+    return Experiment(items + [seq], "experiment")
+
+# name: (generator, argument)
+CASES = {
+    "deep_nesting_100": (deep_nesting, 100),
+    "deep_nesting_10000": (deep_nesting, 10000),
+    "deep_loops_10000": (deep_loops, 10000),
+    "wide_sequence_2000": (wide_sequence, 2000),
+    "huge_loop_100000": (huge_loop, 100000),
+    "element_heavy_5000": (element_heavy, 5000),
+}
@@ -0,0 +1,86 @@
+"""
+Memory used building and translating the larger synthetic experiments (see
+generators.py), with and without the compact_tables option, and the memory
+each producer object takes.
+
+    python benchmarks/memory_benchmark.py
+
+Only the translator refers to the experiment, so with compact_tables it can
+be freed before the JS is written. "peak" is the most memory used at any
+point; "writing" is what is still held when the JS starts to be written,
+which is all there is to the experiment from then on.
+"""
+
+import argparse
+from pathlib import Path
+import sys
+import tracemalloc
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE))
+sys.path.insert(0, str(HERE.parent))
+
+from generators import CASES
+from jspsych_objects import HTMLKeyboard, TranslationContext
+from opensesame_to_jspsych import Convertor
+
+MODES = {"default": {}, "compact_tables": {"compact_tables": True}}
+
+class NullWriter:
+    """
+    Discards the JS, so its size doesn't count, noting the memory in use
+    when it is first written to
+    """
+    def __init__(self):
+        self.bytes_at_start = None
+
+    def write(self, text):
+        if self.bytes_at_start is None:
+            self.bytes_at_start, _ = tracemalloc.get_traced_memory()
+        return len(text)
+
+def measure(generator, argument, options):
+    """
+    Returns (peak bytes, bytes when writing starts)
+    """
+    out = NullWriter()
+    tracemalloc.start()
+    # as batch_translate does, so only the Convertor refers to the experiment
+    convertor = Convertor(generator(argument), owns_experiment=True, **options)
+    convertor.to_jspsych(out)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, out.bytes_at_start
+
+def bytes_per_producer(n=10000):
+    context = TranslationContext()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    producers = [
+        HTMLKeyboard(context, "response", keys=["z", "m"]) for _ in range(n)
+    ]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # without the list itself
+    return (after - before - sys.getsizeof(producers)) / n
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Translator memory use")
+    parser.add_argument("--only", nargs="*",
+        default=["huge_loop_100000", "wide_sequence_2000", "deep_loops_10000"],
+        help="case names to run")
+    args = parser.parse_args(argv)
+
+    for name in args.only:
+        generator, argument = CASES[name]
+        for mode, options in MODES.items():
+            peak, writing = measure(generator, argument, options)
+            print(
+                f"{name:24} {mode:16} {peak / 1e6:8.1f}MB peak "
+                f"{writing / 1e6:8.1f}MB writing"
+            )
+    print(f"HTMLKeyboard: {bytes_per_producer():.0f} bytes each, names included")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
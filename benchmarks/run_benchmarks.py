@@ -0,0 +1,112 @@
+"""
+Translates synthetic experiments (see generators.py) and reports the time
+Convertor.to_jspsych takes, peak memory and output size, compared with the
+stored baselines in baselines.json.
+
+    python benchmarks/run_benchmarks.py            # compare
+    python benchmarks/run_benchmarks.py --update   # store new baselines
+
+Exits non-zero if anything is more than --tolerance worse than its
+baseline. Times are machine dependent: update the baselines on the machine
+the comparison is made on.
+"""
+
+import argparse
+import json
+from pathlib import Path
+import sys
+import time
+import tracemalloc
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE))
+sys.path.insert(0, str(HERE.parent))
+
+from generators import CASES
+from opensesame_to_jspsych import Convertor
+
+BASELINES = HERE / "baselines.json"
+# differences smaller than this are never reported, as timing short runs
+# is noisy
+NOISE = {"seconds": 0.05}
+
+def translate(experiment, options):
+    html, js = Convertor(experiment, **options).to_jspsych()
+    return len(html.encode("utf-8")) + len(js.encode("utf-8"))
+
+def measure(experiment, options, repeat):
+    seconds = min(
+        timed(translate, experiment, options) for _ in range(repeat)
+    )
+    # separately, as tracing slows everything down
+    tracemalloc.start()
+    output_bytes = translate(experiment, options)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "seconds": round(seconds, 4),
+        "peak_bytes": peak_bytes,
+        "output_bytes": output_bytes,
+    }
+
+def timed(func, *args):
+    start_time = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start_time
+
+def compare(result, baseline, tolerance):
+    """
+    Descriptions of measurements more than tolerance worse than baseline
+    """
+    regressions = []
+    for measurement, value in result.items():
+        base = baseline.get(measurement)
+        if (
+            base and value > base * (1 + tolerance)
+            and value - base > NOISE.get(measurement, 0)
+        ):
+            regressions.append(f"{measurement} {base} -> {value}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Translator benchmarks")
+    parser.add_argument("--update", action="store_true",
+        help="store the results as the new baselines")
+    parser.add_argument("--only", nargs="*", default=None,
+        help="case names to run (default all)")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="timing runs per case, the fastest is kept")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+        help="fraction worse than baseline allowed before failing")
+    args = parser.parse_args(argv)
+
+    baselines = {}
+    if BASELINES.exists():
+        baselines = json.loads(BASELINES.read_text())
+    results = {}
+    failed = False
+    for name, (generator, argument) in CASES.items():
+        if args.only is not None and name not in args.only:
+            continue
+        experiment = generator(argument)
+        results[name] = result = measure(experiment, {}, args.repeat)
+        regressions = compare(result, baselines.get(name, {}), args.tolerance)
+        status = "REGRESSED" if regressions else "ok"
+        print(
+            f"{name:24} {result['seconds']:8.3f}s "
+            f"{result['peak_bytes'] / 1e6:9.1f}MB peak "
+            f"{result['output_bytes'] / 1e6:9.2f}MB output  {status}"
+        )
+        for regression in regressions:
+            print(f"    {regression}")
+        failed = failed or bool(regressions)
+
+    if args.update:
+        baselines.update(results)
+        BASELINES.write_text(json.dumps(baselines, indent=4, sort_keys=True) + "\n")
+        print(f"Baselines written to {BASELINES}")
+        return 0
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Lightweight stand-ins for the OpenSesame objects the translator reads, so
+experiments can be built and translated without OpenSesame installed.
+Classes are named like their OpenSesame counterparts, as the translator
+dispatches on class name.
+"""
+
+class Var:
+    """
+    Like an item's var store: attributes, plus get()
+    """
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+    def get(self, name, default=None):
+        return self.__dict__.get(name, default)
+
+class DataMatrix:
+    """
+    Column-oriented table; iterating gives rows as (column, value) pairs
+    """
+    def __init__(self, columns):
+        self._columns = dict(columns)
+        lengths = {len(values) for values in self._columns.values()}
+        assert len(lengths) <= 1, "Columns must have the same length"
+        self._length = lengths.pop() if lengths else 0
+
+    @property
+    def column_names(self):
+        return list(self._columns)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, colname):
+        return self._columns[colname]
+
+    def __delitem__(self, colname):
+        del self._columns[colname]
+
+    def __iter__(self):
+        for idx in range(self._length):
+            yield [(colname, values[idx]) for colname, values in self._columns.items()]
+
+class Item:
+    def __init__(self, name, **var):
+        self.name = name
+        self.var = Var(**var)
+
+    def to_string(self):
+        return f"define {type(self).__name__} {self.name}\n{sorted(self.var.__dict__.items())}"
+
+class sequence(Item):
+    def __init__(self, name, items):
+        """
+        items: (item name, run-if condition) pairs
+        """
+        super().__init__(name)
+        self.items = items
+
+    def to_string(self):
+        return super().to_string() + repr(self.items)
+
+class loop(Item):
+    def __init__(self, name, item, dm, **var):
+        super().__init__(name, **var)
+        self._item = item
+        self.dm = dm
+
+    def to_string(self):
+        return super().to_string() + repr(self._item) + repr(list(self.dm))
+
+class sketchpad(Item):
+    def __init__(self, name, elements, duration="keypress"):
+        super().__init__(name, duration=duration)
+        self.elements = elements
+
+    def to_string(self):
+        return super().to_string() + repr([
+            (type(el).__name__, sorted(el.properties.items()))
+            for el in self.elements
+        ])
+
+class keyboard_response(Item):
+    def __init__(self, name, allowed_responses="space"):
+        super().__init__(name, allowed_responses=allowed_responses)
+
+class notepad(Item):
+    def __init__(self, name, note=""):
+        super().__init__(name, note=note)
+
+class Element:
+    defaults = {}
+
+    def __init__(self, **properties):
+        self.properties = dict(self.defaults)
+        self.properties.update(properties)
+
+class line(Element):
+    defaults = {"color": "white", "penwidth": 1}
+
+class rect(Element):
+    defaults = {"color": "white", "penwidth": 1, "fill": 0}
+
+class textline(Element):
+    defaults = {
+        "color": "white", "font_size": 18, "font_family": "mono",
+        "x": 0, "y": 0
+    }
+
+class Experiment:
+    def __init__(self, items, start):
+        """
+        items: list of Items, start: name of the first sequence
+        """
+        self.items = {item.name: item for item in items}
+        self.var = Var(start=start)
+
+    def to_string(self):
+        return "".join(item.to_string() + "\n" for item in self.items.values())
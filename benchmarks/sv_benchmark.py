@@ -0,0 +1,98 @@
+"""
+Times TranslationContext.sv on realistic stimulus strings against the
+previous implementation (kept below for comparison), and checks both give
+the same JS.
+
+    python benchmarks/sv_benchmark.py
+"""
+
+from pathlib import Path
+import re
+import sys
+import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from jspsych_objects import TranslationContext, escape_for_output
+
+def old_sv(context, text, auto_func=True):
+    text = text.strip()
+    m = re.match(r"^\[(\w+)\]$", text)
+    if m is not None:
+        varname = m.group(1).strip()
+        if not context.is_variable(varname):
+            raise Exception(f"Attempt to reference unregistered variable {varname}")
+        return f'jsPsych.timelineVariable("{varname}")'
+    matches = list(re.finditer(r"\[(\w+)\]", text))
+    if not matches:
+        if text.isnumeric():
+            return text
+        else:
+            return f'"{escape_for_output(text)}"'
+    last_pos = 0
+    inner_js_elements = []
+    for match in matches:
+        literal_raw = text[last_pos:match.span()[0]]
+        if literal_raw:
+            inner_js_elements.append(f'"{escape_for_output(literal_raw)}"')
+        variable = text[match.span()[0]+1:match.span()[1]-1]
+        inner_js_elements.append(f'jsPsych.timelineVariable("{variable}")')
+        last_pos = match.span()[1]
+    literal_raw = text[last_pos:]
+    if literal_raw:
+        inner_js_elements.append(f'"{escape_for_output(literal_raw)}"')
+    inner_js = "\n        +".join(el for el in inner_js_elements)
+    if auto_func:
+        return f"""\
+function () {{
+    return (
+        {inner_js}
+    );
+}}
+"""
+    else:
+        return inner_js
+
+# the kind of thing found in sketchpads and durations
+STIMULI = [
+    '<canvas id="sketchpad"></canvas>',
+    "[duration]",
+    "495",
+    "keypress",
+    '<p style="color: [colour]">[word]</p>',
+    "Trial [trial_nr] of [n_trials]: press [correct_key] for [category]",
+    "<div class=\"instructions\">Press any key to begin block [block]</div>",
+    "[prime] ... [target]",
+]
+
+def main(repeat=20000):
+    context = TranslationContext()
+    for varname in [
+        "duration", "colour", "word", "trial_nr", "n_trials",
+        "correct_key", "category", "block", "prime", "target"
+    ]:
+        context.register_variable(varname)
+    for text in STIMULI:
+        for auto_func in (True, False):
+            assert context.sv(text, auto_func) == old_sv(context, text, auto_func), text
+
+    def run_old():
+        for text in STIMULI:
+            old_sv(context, text)
+            old_sv(context, text, auto_func=False)
+
+    def run_new():
+        for text in STIMULI:
+            context.sv(text)
+            context.sv(text, auto_func=False)
+
+    calls = repeat * len(STIMULI) * 2
+    old_time = min(timeit.repeat(run_old, number=repeat, repeat=3))
+    new_time = min(timeit.repeat(run_new, number=repeat, repeat=3))
+    print(f"{calls} calls")
+    print(f"before: {old_time:.3f}s ({1e6 * old_time / calls:.2f}us per call)")
+    print(f"after:  {new_time:.3f}s ({1e6 * new_time / calls:.2f}us per call)")
+    print(f"speedup: {old_time / new_time:.1f}x")
+
+if __name__ == "__main__":
+    main()
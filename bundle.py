@@ -0,0 +1,110 @@
+# jsPsych, the plugins used and the experiment as one minified script
+
+import functools
+from pathlib import Path
+import re
+
+_TOKEN = re.compile(r"""
+    (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|`(?:[^`\\]|\\.)*`)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<space>\s+)
+  | (?P<word>[\w$\\]+)
+  | (?P<other>.)
+""", re.S | re.X)
+_REGEX = re.compile(r"/(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[a-z]*")
+_WORD_CHAR = re.compile(r"[\w$\\]")
+# after these (or at the start) a / starts a regular expression, not a division
+_REGEX_AFTER_WORDS = {
+    "return", "typeof", "case", "do", "else", "in", "instanceof", "new",
+    "delete", "void", "throw", "yield", "await",
+}
+# a newline after / before these can't end a statement, so can go
+_NO_NEWLINE_AFTER = set(",;{([")
+_NO_NEWLINE_BEFORE = set(")]},;")
+
+def needs_space(before, after):
+    """
+    Whether the characters either side of removed whitespace would join
+    into a different token
+    """
+    if _WORD_CHAR.match(before):
+        return bool(_WORD_CHAR.match(after))
+    return before + after in ("++", "--", "//", "/*")
+
+def minify_js(text):
+    """
+    Removes comments and all whitespace that doesn't separate tokens.
+    Newlines which might end a statement are kept, so automatic semicolon
+    insertion still works. Doesn't look inside ${} in template literals.
+    """
+    out = []
+    # last character written, and the last token that wasn't whitespace
+    last_char = ""
+    last_token = ""
+    last_kind = ""
+    # whitespace skipped since last_char: "", " " or "\n"
+    pending = ""
+    pos = 0
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        kind = m.lastgroup
+        token = m.group()
+        if kind == "other" and token == "/" and (
+            last_kind == "" or last_token in _REGEX_AFTER_WORDS
+            or (last_kind == "other" and last_token not in ")]}")
+        ):
+            regex = _REGEX.match(text, pos)
+            if regex is not None:
+                kind = "regex"
+                token = regex.group()
+        pos += len(token)
+        if kind in ("space", "comment"):
+            if "\n" in token or token.startswith("//"):
+                pending = "\n"
+            elif pending == "":
+                pending = " "
+            continue
+        if pending == "\n" and last_char and not (
+            last_char in _NO_NEWLINE_AFTER or token[0] in _NO_NEWLINE_BEFORE
+        ):
+            out.append("\n")
+        elif pending and last_char and (
+            needs_space(last_char, token[0])
+            # flags
+            or (last_kind == "regex" and _WORD_CHAR.match(token[0]))
+            # "1 .x" is a property of 1, "1.x" a malformed number
+            or (token[0] == "." and last_kind == "word"
+                and last_token[0].isdigit())
+        ):
+            out.append(" ")
+        pending = ""
+        out.append(token)
+        last_char = token[-1]
+        last_token = token
+        last_kind = kind
+    return "".join(out)
+
+@functools.lru_cache(maxsize=64)
+def _minified_file(path, mtime):
+    # mtime is part of the key, so an updated file is read again
+    return minify_js(Path(path).read_text(encoding="utf-8"))
+
+def minified_file(path):
+    path = Path(path)
+    if not path.exists():
+        raise Exception(f"Can't bundle {path}, which doesn't exist")
+    return _minified_file(str(path), path.stat().st_mtime)
+
+def bundle_js(jspsych_dir, plugins, experiment_js):
+    """
+    jsPsych (jspsych_dir/jspsych.js), then each plugin (e.g.
+    "call-function", from jspsych_dir/plugins), then experiment_js, all
+    minified
+    """
+    jspsych_dir = Path(jspsych_dir)
+    parts = [minified_file(jspsych_dir / "jspsych.js")]
+    for plugin in sorted(plugins):
+        parts.append(minified_file(jspsych_dir / "plugins" / f"jspsych-{plugin}.js"))
+    parts.append(minify_js(experiment_js))
+    # the semicolons stop one file's last statement running into the next
+    return ";\n".join(parts) + "\n"
@@ -0,0 +1,51 @@
+# Where the time goes in a translation
+
+import time
+
+class Instrumentation:
+    """
+    Pass one in (opensesame_to_jspsych(experiment, instrumentation=...)) to
+    collect timings and counts, then call report() or format().
+    Without one, the translator only pays for an "is None" check.
+    Times for sequences, loops and timelines include their contents.
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, stage, start_time):
+        """
+        start_time: from time.perf_counter()
+        """
+        self.seconds[stage] = (
+            self.seconds.get(stage, 0.0) + time.perf_counter() - start_time
+        )
+
+    def report(self):
+        return {"seconds": dict(self.seconds), "counts": dict(self.counts)}
+
+    def format(self):
+        lines = ["Timings:"]
+        for stage, seconds in sorted(
+            self.seconds.items(), key=lambda item: -item[1]
+        ):
+            lines.append(f"    {stage:32} {seconds:9.4f}s")
+        lines.append("Counts:")
+        for name, n in sorted(self.counts.items()):
+            lines.append(f"    {name:32} {n:9}")
+        return "\n".join(lines)
+
+class CountingWriter:
+    """
+    Wraps an output, counting the bytes (as UTF-8) written to it
+    """
+    def __init__(self, out, instrumentation):
+        self.out = out
+        self.instrumentation = instrumentation
+
+    def write(self, text):
+        self.instrumentation.count("bytes written", len(text.encode("utf-8")))
+        return self.out.write(text)
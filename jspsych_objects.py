@@ -1,21 +1,400 @@
 # Exist just to be translated to JS!
 
+from array import array
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
 from pathlib import Path
 import re
+import time
+
+from assets import AssetManifest, IMAGES_JS
+from bundle import bundle_js
+from output import atomic_write
+from patches import PatchRenderer
+
+# Rebuilds timeline_variables rows from a table written column by column
+COLUMNS_TO_ROWS_JS = """\
+function jspsych_columns_to_rows(length, columns) {
+    var names = Object.keys(columns);
+    var rows = new Array(length);
+    for (var i = 0; i < length; i++) {
+        var row = {};
+        for (var j = 0; j < names.length; j++) {
+            row[names[j]] = columns[names[j]][i];
+        }
+        rows[i] = row;
+    }
+    return rows;
+}
+
+"""
+
+# Fills in loop tables written to separate files (external_tables option)
+# before the experiment starts. Gzipped tables are decompressed here, so
+# they must be served as plain files, *not* with Content-Encoding: gzip
+LOAD_TABLES_JS = """\
+var jspsych_tables = [];
+function jspsych_load_tables() {
+    return Promise.all(jspsych_tables.map(function (table) {
+        return fetch(table.url).then(function (response) {
+            if (!response.ok) {
+                throw new Error("Could not load " + table.url);
+            }
+            if (table.gzip) {
+                response = new Response(
+                    response.body.pipeThrough(new DecompressionStream("gzip"))
+                );
+            }
+            return response.json();
+        }).then(function (data) {
+            var rows = jspsych_columns_to_rows(data.length, data.columns);
+            for (var i = 0; i < rows.length; i++) {
+                table.target.push(rows[i]);
+            }
+        });
+    }));
+}
+
+"""
+
+# Static sketchpads (prerender_sketchpads option) are drawn once into a
+# canvas that isn't on the page, then copied to the screen when shown
+PRERENDER_JS = """\
+var jspsych_prerendered = {};
+function jspsych_prerender(key, draw) {
+    var canvas = document.createElement("canvas");
+    var ctx = canvas.getContext("2d");
+    ctx.textAlign = "center";
+    ctx.textBaseline = "middle";
+    draw(canvas, ctx);
+    jspsych_prerendered[key] = canvas;
+}
+function jspsych_blit(key) {
+    var cached = jspsych_prerendered[key];
+    var canvas = document.getElementById("sketchpad");
+    canvas.width = cached.width;
+    canvas.height = cached.height;
+    canvas.getContext("2d").drawImage(cached, 0, 0);
+}
+
+"""
+
+# Timestamps (performance.now(), ms) for the telemetry option: the visual
+# stimulus changing, its drawing code finishing and the trial ending, plus
+# every animation frame in between. Added to each response trial's data.
+TELEMETRY_JS = """\
+var jspsych_telemetry = {visual_change: null, drawn: null, frames: [], running: false};
+function jspsych_telemetry_visual() {
+    jspsych_telemetry.visual_change = performance.now();
+}
+function jspsych_telemetry_start() {
+    var t = jspsych_telemetry;
+    t.drawn = performance.now();
+    t.frames = [];
+    t.running = true;
+    function frame(stamp) {
+        if (t.running) {
+            t.frames.push(stamp);
+            requestAnimationFrame(frame);
+        }
+    }
+    requestAnimationFrame(frame);
+}
+function jspsych_telemetry_finish(data, requested_duration) {
+    var t = jspsych_telemetry;
+    var end = performance.now();
+    t.running = false;
+    var intervals = [];
+    for (var i = 1; i < t.frames.length; i++) {
+        intervals.push(t.frames[i] - t.frames[i - 1]);
+    }
+    // the display's frame period, from the typical interval
+    var sorted = intervals.slice().sort(function (a, b) { return a - b; });
+    var period = sorted.length ? sorted[Math.floor(sorted.length / 2)] : null;
+    var dropped = 0, sum = 0, sum_squares = 0;
+    for (var i = 0; i < intervals.length; i++) {
+        dropped += Math.max(0, Math.round(intervals[i] / period) - 1);
+        sum += intervals[i];
+        sum_squares += intervals[i] * intervals[i];
+    }
+    var mean = intervals.length ? sum / intervals.length : null;
+    data.telemetry_visual_change = t.visual_change;
+    data.telemetry_draw_latency = t.visual_change === null ? null : t.drawn - t.visual_change;
+    data.telemetry_first_frame_latency = t.frames.length ? t.frames[0] - t.drawn : null;
+    data.telemetry_duration = end - t.drawn;
+    data.telemetry_duration_error = (
+        requested_duration === null ? null : end - t.drawn - requested_duration
+    );
+    data.telemetry_frames = t.frames.length;
+    data.telemetry_frame_period = period;
+    data.telemetry_dropped_frames = dropped;
+    data.telemetry_frame_jitter = (
+        mean === null ? null : Math.sqrt(Math.max(0, sum_squares / intervals.length - mean * mean))
+    );
+}
+
+"""
+
+# Rows to run for a loop repeated a fractional number of times: whole
+# copies of the table, then part of it, as OpenSesame does
+REPEAT_JS = """\
+function jspsych_repeat(indices, repeat, random) {
+    var result = [];
+    var full = Math.floor(repeat);
+    for (var i = 0; i < full; i++) {
+        result = result.concat(indices);
+    }
+    var part = Math.round((repeat - full) * indices.length);
+    var rest = random ? jsPsych.randomization.shuffle(indices) : indices;
+    result = result.concat(rest.slice(0, part));
+    return random ? jsPsych.randomization.shuffle(result) : result;
+}
+"""
 
 def escape_for_output(html):
     return html.replace('"', r'\"')
 
-def build_timeline(context, timeline):
+def _json_default(value):
+    # numpy scalars from DataMatrix columns
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+def js_value(value):
+    """
+    A loop table cell as a JS literal
+    """
+    return json.dumps(value, default=_json_default)
+
+# marks a loop column with more than one value, see TranslationContext.enter_loop
+_NOT_FOLDED = object()
+
+def single_value(column):
+    """
+    The value in every cell of column, or _NOT_FOLDED
+    """
+    cells = iter(column)
+    first = next(cells, _NOT_FOLDED)
+    for cell in cells:
+        if cell != first:
+            return _NOT_FOLDED
+    return first
+
+def write_tree(producer, out):
+    """
+    Writes producer and everything inside it to out, running js_steps
+    generators from a stack so deep nesting doesn't grow the Python stack
+    """
+    stack = [producer.js_steps(out)]
+    while stack:
+        inner = next(stack[-1], None)
+        if inner is None:
+            stack.pop()
+        else:
+            stack.append(inner.js_steps(out))
+
+def build_timeline(context, timeline, out, report_progress=False):
+    """
+    Generator for js_steps: yields each item in timeline to have its code
+    written to out, returns the names to go in the jsPsych timeline array.
+    report_progress: pass progress through each item on to the context
+    (for the top timeline)
+    """
     timeline_without_comments = [
         t for t in timeline
         if t.name not in context.comment_names
     ]
-    code_str = "\n".join(
-        t.to_js() for t in timeline_without_comments
-    )
+    instrumentation = context.instrumentation
+    for idx, t in enumerate(timeline_without_comments):
+        context.check_cancelled()
+        if idx > 0:
+            out.write("\n")
+        if instrumentation is None:
+            yield t
+        else:
+            start_time = time.perf_counter()
+            yield t
+            instrumentation.add_time(f"emit {type(t).__name__}", start_time)
+        if report_progress:
+            context.report_progress(
+                "Writing", idx + 1, len(timeline_without_comments)
+            )
     timeline_str = ",".join(t.name for t in timeline_without_comments)
-    return code_str, timeline_str
+    return timeline_str
+
+_SINGLE_VARIABLE = re.compile(r"^\[(\w+)\]$")
+_VARIABLE = re.compile(r"\[(\w+)\]")
+
+class CompiledText:
+    """
+    Text split into literal and variable tokens, with the JS for it
+    (see TranslationContext.sv)
+    tokens: (is_variable, literal text or variable name) pairs
+    """
+    __slots__ = ("tokens", "variables", "inline_js", "func_js")
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.variables = tuple(value for is_var, value in tokens if is_var)
+        self.inline_js = join_js(token_to_js(token) for token in tokens)
+        if len(tokens) > 1:
+            self.func_js = function_js(self.inline_js)
+        else:
+            self.func_js = self.inline_js
+
+def join_js(elements):
+    return "\n        +".join(elements)
+
+def function_js(inline_js):
+    """
+    A function returning inline_js, so timeline variables in it are looked
+    up when the trial runs
+    """
+    return f"""\
+function () {{
+    return (
+        {inline_js}
+    );
+}}
+"""
+
+def token_to_js(token):
+    is_var, value = token
+    if is_var:
+        return f'jsPsych.timelineVariable("{value}")'
+    return f'"{escape_for_output(value)}"'
+
+@functools.lru_cache(maxsize=8192)
+def compile_text(text):
+    """
+    Parses stripped text once; later calls with the same text are cached
+    """
+    # firstly, is the text a single variable?
+    m = _SINGLE_VARIABLE.match(text)
+    if m is not None:
+        return CompiledText(((True, m.group(1)),))
+    # split text into chunks -- literal, variable, literal, variable
+    tokens = []
+    last_pos = 0
+    for match in _VARIABLE.finditer(text):
+        start, end = match.span()
+        # string before match, excluding empty
+        if start > last_pos:
+            tokens.append((False, text[last_pos:start]))
+        tokens.append((True, match.group(1)))
+        last_pos = end
+    if not tokens: # no variables -- return unmodified text
+        compiled = CompiledText(((False, text),))
+        # got to do some OpenSesame type guessing though
+        if text.isnumeric():
+            compiled.inline_js = compiled.func_js = text # TODO: account for reals
+        return compiled
+    # last literal?
+    if last_pos < len(text):
+        tokens.append((False, text[last_pos:]))
+    return CompiledText(tuple(tokens))
+
+def compact_column(values, shared_string):
+    """
+    values as an array.array if they are all integers or all floats,
+    otherwise as a list with repeated strings shared
+    """
+    # not as a list first: the column may be the largest thing held
+    def cells():
+        return (
+            value.item() if hasattr(value, "item") else value
+            for value in values
+        )
+    types = {type(cell) for cell in cells()}
+    if types == {int}:
+        try:
+            return array("q", cells())
+        except OverflowError:
+            pass
+    elif types == {float}:
+        return array("d", cells())
+    return [
+        shared_string(cell) if type(cell) is str else cell for cell in cells()
+    ]
+
+class ColumnTable:
+    """
+    A loop table copied into compact columns (see compact_column), for the
+    compact_tables option. Has the parts of DataMatrix the translator uses,
+    so the DataMatrix, and the experiment, needn't be kept while the JS is
+    written.
+    """
+    __slots__ = ("column_names", "_columns", "_length")
+
+    def __init__(self, table, shared_string, release=False):
+        """
+        release: delete each column from table once copied, so only one
+         column is ever held twice
+        """
+        self.column_names = list(table.column_names)
+        self._length = len(table)
+        self._columns = {}
+        for colname in self.column_names:
+            self._columns[colname] = compact_column(table[colname], shared_string)
+            if release:
+                del table[colname]
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, colname):
+        return self._columns[colname]
+
+    def __iter__(self):
+        # rows as (column, value) pairs, as DataMatrix gives them
+        columns = [(colname, self._columns[colname]) for colname in self.column_names]
+        for idx in range(self._length):
+            yield [(colname, column[idx]) for colname, column in columns]
+
+class NameAllocator:
+    """
+    The set of names used so far. Unique names are found the same way as
+    always (try name, name_1, name_2, ...) but the next suffix to try is
+    remembered for each base name, so allocating many copies of the same
+    name doesn't get slower. As names are never removed, no suffix below
+    the remembered one can become free again.
+    """
+    def __init__(self):
+        self._names = set()
+        self._next_suffix = {}
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name):
+        self._names.add(name)
+
+    def unique(self, name):
+        """
+        A name not yet used based on name (does not reserve it)
+        """
+        if name not in self._names:
+            return name
+        count = self._next_suffix.get(name, 1)
+        while f"{name}_{count}" in self._names:
+            count += 1
+        self._next_suffix[name] = count
+        return f"{name}_{count}"
+
+class TranslationCancelled(Exception):
+    """
+    Raised out of a translation when its cancel_event is set
+    """
 
 class TranslationContext:
     """
@@ -24,25 +403,190 @@ class TranslationContext:
     Also holds setup at the start of the file, and the plugins used as we
     translate.
     """
-    def __init__(self):
-        self.names = set()
+    def __init__(
+        self, columnar_tables=False, output_dir=None, external_tables=False,
+        compress_tables=False, cache=None, instrumentation=None,
+        prerender_sketchpads=False, patch_cache_dir=None, progress=None,
+        cancel_event=None, optimize=False, bundle=False, jspsych_dir=None,
+        telemetry=False, compact_tables=False, item_hashes=None
+    ):
+        """
+        columnar_tables: write loop tables one array per column rather than
+         one object per row (much smaller for large tables)
+        output_dir: the directory experiment.js will be written to, needed
+         for anything written alongside it
+        external_tables: write loop tables to output_dir/tables, fetched
+         before the experiment starts. Files are named by content hash so
+         unchanged tables stay cached in the browser. Older versions are
+         left in place, as the last experiment.js may still use them; see
+         OutputDirectory.prune.
+        compress_tables: gzip external tables
+        cache: a TranslationCache, to reuse sketchpad code and large loop
+         tables from earlier translations
+        instrumentation: an Instrumentation, to collect timings and counts
+        prerender_sketchpads: draw sketchpads without variables once, at
+         startup, rather than each time they are shown
+        patch_cache_dir: where to keep rendered gabor and noise patches
+         between translations
+        progress: called as progress(stage, done, total) as each top-level
+         item is translated and written, e.g. to update a progress bar
+        cancel_event: a threading.Event; once it is set the translation
+         stops with TranslationCancelled
+        optimize: leave out items run if "never", write loop columns with
+         the same value in every row as literals where they are used, and
+         drop loop columns nothing uses
+        bundle: write jsPsych, the plugins used and the experiment as one
+         minified script in output_dir/assets, named by content hash, and
+         load only that from the HTML
+        jspsych_dir: where jsPsych is, for bundle (default
+         output_dir/external/jspsych, where the HTML otherwise loads it from)
+        telemetry: record when stimuli change and are drawn, when trials
+         end and how many frames were dropped, in each response trial's data
+         (see TELEMETRY_JS)
+        compact_tables: copy loop tables into compact columns (see
+         ColumnTable) as they are translated, and let go of the experiment
+         before writing the JS, so it can be freed. Lowers peak memory only
+         if the experiment's tables are released as they are copied (see
+         Convertor's owns_experiment); otherwise both are held until the
+         tree is built.
+        item_hashes: name: hash of each item (see script_hashes) for cache
+         keys, if the experiment was parsed from a script, so the items
+         needn't be serialised to find which have changed
+        """
+        self.names = NameAllocator()
         self.comment_names = set() # to exclude from timelines
         self.setup = "var jspsych_globals = {};\n\n"
+        self.columnar_tables = columnar_tables
+        self.output_dir = None if output_dir is None else Path(output_dir)
+        self.external_tables = external_tables
+        self.compress_tables = compress_tables
+        if self.external_tables and self.output_dir is None:
+            raise Exception("external_tables needs an output_dir to write to")
+        if self.columnar_tables or self.external_tables:
+            self.setup += COLUMNS_TO_ROWS_JS
+        if self.external_tables:
+            self.setup += LOAD_TABLES_JS
+        self.prerender_sketchpads = prerender_sketchpads
+        if self.prerender_sketchpads:
+            self.setup += PRERENDER_JS
+        self.telemetry = telemetry
+        if self.telemetry:
+            self.setup += TELEMETRY_JS
+        # URLs (relative to experiment.html) of files to preload
+        self.table_files = []
+        self.assets = AssetManifest(self.output_dir)
+        # the experiment's file pool (name: path), set by Convertor
+        self.pool = None
+        self.patches = PatchRenderer(patch_cache_dir)
+        # tables of the loops being translated, innermost last, set by
+        # Convertor
+        self.loop_tables = []
+        # id(table): hash of its contents, see loop_tables_key
+        self._table_hashes = {}
+        self.cache = cache
+        self.item_hashes = item_hashes
+        self.instrumentation = instrumentation
+        self.progress = progress
+        self.cancel_event = cancel_event
+        self.optimize = optimize
+        self.compact_tables = compact_tables
+        # text: the same text, see shared_string
+        self._strings = {}
+        self.bundle = bundle
+        if self.bundle and self.output_dir is None:
+            raise Exception("bundle needs an output_dir to write to")
+        if jspsych_dir is None and self.output_dir is not None:
+            jspsych_dir = self.output_dir / "external" / "jspsych"
+        self.jspsych_dir = jspsych_dir
+        # set by write_bundle
+        self.bundle_url = None
+        # with optimize, varname: value for each loop in scope defining it,
+        # innermost last (_NOT_FOLDED unless the column has a single value)
+        self._folded = {}
+        # with optimize, (column names, names referenced) for each loop in
+        # scope, innermost last
+        self._scopes = []
+        # sets of names referenced, see recorded
+        self._recordings = []
+        # function body: name, see shared_function
+        self._shared_functions = {}
+        # see write_once
+        self._written_once = set()
+        # options that change the output of cached fragments
+        self._cache_salt = repr((
+            columnar_tables, external_tables, compress_tables,
+            prerender_sketchpads, output_dir is None, optimize, telemetry
+        ))
         self.plugins_used = set()
         # varname: nest count (in case same variable is reused in inner loop)
         # when nest count gets to 0 we delete it
         self._variables = {}
 
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise TranslationCancelled()
+
+    def report_progress(self, stage, done, total):
+        if self.progress is not None:
+            self.progress(stage, done, total)
+
     def html_template(self):
         path = Path.resolve(Path.cwd() / Path(__file__))
         return open(path.parent / "experiment_template.html").read()
 
     def generate_html(self):
         # call after all JS has been generated to get plugins used
-        plugin_html = ""
-        for plugin in self.plugins_used:
-            plugin_html += f'<script src="external/jspsych/plugins/jspsych-{plugin}.js"></script>\n'
-        return self.html_template().replace('{plugins}', plugin_html)
+        if self.bundle_url is not None:
+            script_urls = [self.bundle_url]
+        else:
+            script_urls = ["external/jspsych/jspsych.js"] + [
+                f"external/jspsych/plugins/jspsych-{plugin}.js"
+                for plugin in sorted(self.plugins_used)
+            ] + ["experiment.js"]
+        scripts_html = "".join(
+            f'<script src="{url}"></script>\n' for url in script_urls
+        )
+        preload_html = ""
+        for url in self.table_files:
+            preload_html += f'<link rel="preload" href="{url}" as="fetch" crossorigin="anonymous">\n'
+        for url in self.assets.preload_urls("image"):
+            preload_html += f'<link rel="preload" href="{url}" as="image">\n'
+        return (
+            self.html_template()
+            .replace('{preload}', preload_html)
+            .replace('{scripts}', scripts_html)
+        )
+
+    def write_bundle(self, experiment_js):
+        """
+        Call after all JS has been generated, see bundle
+        """
+        content = bundle_js(self.jspsych_dir, self.plugins_used, experiment_js)
+        self.bundle_url = self.assets.store(
+            Path("experiment.js"), content.encode("utf-8")
+        )
+
+    def write_table_file(self, name, data):
+        """
+        Writes data (JSON-able) to output_dir/tables, returns its URL
+        """
+        content = json.dumps(data, default=_json_default).encode("utf-8")
+        digest = hashlib.sha1(content).hexdigest()[:12]
+        suffix = ".json"
+        if self.compress_tables:
+            # mtime=0 so the same table always gives the same bytes
+            content = gzip.compress(content, mtime=0)
+            suffix += ".gz"
+        table_dir = self.output_dir / "tables"
+        table_dir.mkdir(parents=True, exist_ok=True)
+        filename = f"{name}.{digest}{suffix}"
+        path = table_dir / filename
+        if not path.exists():
+            with atomic_write(path, "wb") as f:
+                f.write(content)
+        url = f"tables/{filename}"
+        self.table_files.append(url)
+        return url
 
     def register_variable(self, varname):
         if varname in self._variables:
@@ -61,60 +605,239 @@ class TranslationContext:
         else:
             raise Exception(f"Attempt to unregister {varname} which was not registered")
 
+    def shared_function(self, base_name, body, out):
+        """
+        Returns the name of a JS function with this body, writing it to out
+        the first time a body is seen
+        """
+        name = self._shared_functions.get(body)
+        if name is None:
+            name = self.names.unique(base_name)
+            self.names.add(name)
+            self._shared_functions[body] = name
+            out.write(f"function {name}() {{\n{body}\n}}\n\n")
+        return name
+
+    def shared_string(self, text):
+        """
+        The first string equal to text seen, so producers holding equal
+        strings (e.g. the code for a sketchpad used in many places) hold
+        one copy between them
+        """
+        return self._strings.setdefault(text, text)
+
+    def write_once(self, text, out):
+        """
+        Writes text to out unless it has been written before
+        """
+        if text not in self._written_once:
+            self._written_once.add(text)
+            out.write(text + "\n")
+
+    def enter_loop(self, table):
+        """
+        Brings the columns of a loop table into scope, for translating or
+        writing what is inside the loop
+        """
+        for colname in table.column_names:
+            self.register_variable(colname)
+        self.loop_tables.append(table)
+        if self.optimize:
+            self._scopes.append((set(table.column_names), set()))
+            for colname in table.column_names:
+                self._folded.setdefault(colname, []).append(
+                    single_value(table[colname])
+                )
+
+    def exit_loop(self):
+        """
+        Undoes enter_loop. With optimize, returns the names of the columns
+        referenced (see reference) while in scope, otherwise None.
+        """
+        table = self.loop_tables.pop()
+        for colname in table.column_names:
+            self.unregister_variable(colname)
+        if not self.optimize:
+            return None
+        for colname in table.column_names:
+            self._folded[colname].pop()
+            if not self._folded[colname]:
+                del self._folded[colname]
+        return self._scopes.pop()[1]
+
+    def folded_values(self, varnames):
+        """
+        varname: value for those of varnames written as literals
+        """
+        folded = {}
+        for varname in varnames:
+            values = self._folded.get(varname)
+            if values and values[-1] is not _NOT_FOLDED:
+                folded[varname] = values[-1]
+        return folded
+
+    def reference(self, varname):
+        """
+        Notes that the generated JS looks varname up in the timeline, so
+        its column must be written
+        """
+        for referenced in self._recordings:
+            referenced.add(varname)
+        for colnames, referenced in reversed(self._scopes):
+            if varname in colnames:
+                referenced.add(varname)
+                break
+
+    def recorded(self, compute):
+        """
+        Returns compute() and the variables it referenced, so the
+        references can be replayed (see replay) if the result is cached
+        """
+        referenced = set()
+        self._recordings.append(referenced)
+        try:
+            value = compute()
+        finally:
+            self._recordings.pop()
+        return value, tuple(sorted(referenced))
+
+    def replay(self, referenced):
+        for varname in referenced:
+            self.reference(varname)
+
     def is_variable(self, varname):
         return varname in self._variables
 
+    def variables_key(self):
+        key = tuple(sorted(self._variables))
+        if self._folded:
+            # what is folded changes the JS
+            key += (repr(sorted(
+                (varname, values[-1]) for varname, values in self._folded.items()
+                if values[-1] is not _NOT_FOLDED
+            )),)
+        return key
+
+    def loop_tables_key(self):
+        """
+        Hashes of the contents of the loop tables in scope, for cache keys
+        of anything depending on them
+        """
+        key = []
+        for table in self.loop_tables:
+            if id(table) not in self._table_hashes:
+                contents = repr([
+                    (colname, list(table[colname]))
+                    for colname in table.column_names
+                ])
+                self._table_hashes[id(table)] = hashlib.sha1(
+                    contents.encode("utf-8")
+                ).hexdigest()
+            key.append(self._table_hashes[id(table)])
+        return tuple(key)
+
+    def variable_values(self, varnames):
+        """
+        Every combination of values varnames can take, from the loop tables
+        in scope, as tuples in the order of varnames
+        """
+        # the innermost loop defining each variable
+        by_table = {}
+        for varname in varnames:
+            for idx in reversed(range(len(self.loop_tables))):
+                if varname in self.loop_tables[idx].column_names:
+                    by_table.setdefault(idx, []).append(varname)
+                    break
+            else:
+                raise Exception(f"Variable {varname} is not from a loop table")
+        # rows of one table go together; tables vary independently
+        per_table = []
+        for idx, table_varnames in by_table.items():
+            table = self.loop_tables[idx]
+            rows = zip(*(table[varname] for varname in table_varnames))
+            distinct = list(dict.fromkeys(tuple(row) for row in rows))
+            per_table.append((table_varnames, distinct))
+        for combination in itertools.product(*(d for _, d in per_table)):
+            values = {}
+            for (table_varnames, _), row in zip(per_table, combination):
+                values.update(zip(table_varnames, row))
+            yield tuple(values[varname] for varname in varnames)
+
+    def cached(self, key, compute, valid=None):
+        """
+        Looks up key (a tuple of strings) in the cache; on a miss, calls
+        compute() and stores the result
+        valid: called with the cached value, returns False if it is out of
+         date (e.g. refers to a file that has changed since)
+        """
+        if self.cache is None:
+            return compute()
+        key = (self._cache_salt,) + key
+        value = self.cache.get(key)
+        if value is not None and valid is not None and not valid(value):
+            value = None
+        if value is None:
+            value = compute()
+            self.cache.put(key, value)
+            if self.instrumentation is not None:
+                self.instrumentation.count("cache misses")
+        elif self.instrumentation is not None:
+            self.instrumentation.count("cache hits")
+        return value
+
     def sv(self, text, auto_func=True):
         """
         Substitute variables if present
         auto_func: Automatically create a function if needed to combine
          timeline vars and other values
         """
-        text = text.strip()
-        # firstly, is the text a single variable?
-        m = re.match(r"^\[(\w+)\]$", text)
-        if m is not None:
-            varname = m.group(1).strip()
+        if self.instrumentation is not None:
+            start_time = time.perf_counter()
+            result = self._sv(text, auto_func)
+            self.instrumentation.add_time("substitution", start_time)
+            self.instrumentation.count("substitutions")
+            return result
+        return self._sv(text, auto_func)
+
+    def _sv(self, text, auto_func):
+        compiled = compile_text(text.strip())
+        for varname in compiled.variables:
             if varname not in self._variables:
                 raise Exception(f"Attempt to reference unregistered variable {varname}")
-            return f'jsPsych.timelineVariable("{varname}")'
-        # if not, write a function which substitutes the variable in
-        # split text into chunks -- literal, variable, literal, variable
-        matches = list(re.finditer(r"\[(\w+)\]", text))
-        if not matches: # no variables -- return unmodified text
-            # got to do some OpenSesame type guessing though
-            if text.isnumeric():
-                return text # TODO: account for reals
-            else:
-                return f'"{escape_for_output(text)}"'
-        last_pos = 0
-        inner_js_elements = []
-        for match in matches:
-            # string before match
-            literal_raw = text[last_pos:match.span()[0]]
-            if literal_raw: # exclude empty
-                inner_js_elements.append(f'"{escape_for_output(literal_raw)}"')
-            # variable string
-            variable = text[match.span()[0]+1:match.span()[1]-1]
-            inner_js_elements.append(f'jsPsych.timelineVariable("{variable}")')
-            last_pos = match.span()[1]
-        # last literal?
-        literal_raw = text[last_pos:]
-        if literal_raw:
-            inner_js_elements.append(f'"{escape_for_output(literal_raw)}"')
-        inner_js = "\n        +".join(el for el in inner_js_elements)
+        if self.optimize and compiled.variables:
+            return self._optimized_sv(compiled, auto_func)
         if auto_func:
-            return f"""\
-function () {{
-    return (
-        {inner_js}
-    );
-}}
-"""
+            return compiled.func_js
         else:
-            return inner_js
+            return compiled.inline_js
+
+    def _optimized_sv(self, compiled, auto_func):
+        """
+        _sv with folded variables written as literals
+        """
+        folded = self.folded_values(compiled.variables)
+        for varname in compiled.variables:
+            if varname not in folded:
+                self.reference(varname)
+        if not folded:
+            return compiled.func_js if auto_func else compiled.inline_js
+        inline_js = join_js(
+            js_value(folded[value]) if is_var and value in folded
+            else token_to_js((is_var, value))
+            for is_var, value in compiled.tokens
+        )
+        if (
+            auto_func and len(compiled.tokens) > 1
+            and len(folded) < len(set(compiled.variables))
+        ):
+            return function_js(inline_js)
+        return inline_js
 
 class JSPsychProducer:
+    # there can be very many producers, so no per-instance __dict__;
+    # subclasses list their own attributes
+    __slots__ = ("context", "name", "plugin")
+
     def __init__(self, _context, _name):
         self.context = _context
         self.name = self.get_unique_name(_name)
@@ -122,43 +845,78 @@ class JSPsychProducer:
         self.plugin = None
 
     def get_unique_name(self, _name):
-        attempt_name = _name
-        count = 1
-        while attempt_name in self.context.names:
-            attempt_name = f"{_name}_{count}"
-            count += 1
-        return attempt_name
+        return self.context.names.unique(_name)
+
+    def to_js(self, out):
+        """
+        Write the JS for this item to out (anything with a write method)
+        """
+        self.register_plugin()
 
-    def to_js(self):
+    def register_plugin(self):
         if self.plugin is not None:
             self.context.plugins_used.add(self.plugin)
 
+    def js_steps(self, out):
+        """
+        For write_tree: an iterator yielding the producers inside this one,
+        each to be written before the iterator is resumed. Producers with
+        nothing inside just write their JS.
+        """
+        self.to_js(out)
+        return iter(())
+
 class ChangeVisualStim(JSPsychProducer):
-    def __init__(self, _context, _name, _html, _js, _condition):
+    """
+    The drawing code and the call-function body are written once each as
+    named functions and shared by every ChangeVisualStim which would have
+    the same code, e.g. a fixation screen shown many times.
+    """
+    __slots__ = ("html", "js", "condition", "prerender_js")
+
+    def __init__(
+        self, _context, _name, _html, _js, _condition, _prerender_js=None
+    ):
+        """
+        _prerender_js: statement to run once at startup, before the trial
+        """
         super().__init__(_context, _name)
-        self.html = _html
-        self.js = _js
+        self.html = self.context.shared_string(_html)
+        self.js = self.context.shared_string(_js)
         self.condition = _condition
+        self.prerender_js = _prerender_js
+        if _prerender_js is not None:
+            self.prerender_js = self.context.shared_string(_prerender_js)
         self.plugin = "call-function"
 
-    def to_js(self):
-        super().to_js()
+    def to_js(self, out):
+        super().to_js(out)
+        if self.prerender_js is not None:
+            self.context.write_once(self.prerender_js, out)
         content = self.context.sv(self.html,auto_func=False)
-        return f"""\
+        postload_name = self.context.shared_function(
+            "jspsych_postload", self.js, out
+        )
+        body = f"""\
+    jspsych_globals["current_visual"] = (
+        {content}
+    );
+    jspsych_globals["current_postload_js"] = {postload_name};"""
+        if self.context.telemetry:
+            body += "\n    jspsych_telemetry_visual();"
+        func_name = self.context.shared_function(
+            "jspsych_change_visual", body, out
+        )
+        out.write(f"""\
 var {self.name} = {{
     type: "call-function",
-    func: function () {{
-        jspsych_globals["current_visual"] = (
-            {content}
-        );
-        jspsych_globals["current_postload_js"] = function () {{
-            {self.js}
-        }};
-    }}
+    func: {func_name}
 }};
-"""
+""")
 
 class Timeline(JSPsychProducer):
+    __slots__ = ("timeline", "init")
+
     def __init__(self, _context, _name, _timeline, _init=False):
         """
         When _init = True, call jsPsych.init (top timeline)
@@ -167,105 +925,308 @@ class Timeline(JSPsychProducer):
         self.timeline = _timeline
         self.init = _init
 
-    def to_js(self):
-        super().to_js()
-        result = ""
+    def to_js(self, out):
+        write_tree(self, out)
+
+    def js_steps(self, out):
+        super().to_js(out)
         if self.init:
-            result += self.context.setup
-        code_str, timeline_str = build_timeline(self.context, self.timeline)
-        result += code_str
+            out.write(self.context.setup)
+        timeline_str = yield from build_timeline(
+            self.context, self.timeline, out, report_progress=self.init
+        )
         if self.init:
-            result += f"""\
+            # everything has been translated, so all assets are known;
+            # promises of what has to load before the experiment starts
+            waits = []
+            if self.context.assets.urls("image"):
+                out.write(IMAGES_JS)
+                image_urls = json.dumps(self.context.assets.urls("image"))
+                waits.append(f"jspsych_load_images({image_urls})")
+            if self.context.external_tables:
+                waits.append("jspsych_load_tables()")
+            init_params = ",\n    ".join(
+                [f"timeline: [{timeline_str}]"] +
+                self.context.assets.preload_js()
+            )
+        if self.init and waits:
+            init_params = init_params.replace("\n", "\n    ")
+            wait = waits[0]
+            if len(waits) > 1:
+                wait = f"Promise.all([{', '.join(waits)}])"
+            out.write(f"""\
+{wait}.then(function () {{
+    jsPsych.init({{
+        {init_params}
+    }});
+}});
+""")
+        elif self.init:
+            out.write(f"""\
 jsPsych.init({{
-    timeline: [{timeline_str}]
+    {init_params}
 }});
-"""
+""")
         else:
-            result += f"""\
+            out.write(f"""\
 var {self.name} = {{
     timeline: [{timeline_str}]
 }};
-"""
-        return result
+""")
+
+# smaller loop tables are quicker to write again than to look up in the cache
+CACHED_TABLE_CELLS = 100
 
 class Loop(JSPsychProducer):
-    def __init__(self, _context, _name, _inner_timeline, _table):
+    __slots__ = (
+        "inner_timeline", "table", "repeat", "order", "referenced", "cache_key"
+    )
+
+    def __init__(
+        self, _context, _name, _inner_timeline, _table, repeat=1,
+        order="sequential", referenced=None
+    ):
+        """
+        repeat (may be fractional) and order ("sequential" or "random") are
+        done by jsPsych, so the table is only written once.
+        referenced: with the optimize option, the columns referenced while
+        translating the items inside the loop
+        """
         super().__init__(_context, _name)
         self.inner_timeline = _inner_timeline
         self.table = _table
+        self.repeat = repeat
+        self.order = order
+        self.referenced = referenced
+        # hash of the loop item, set by Convertor with a cache, see
+        # write_table
+        self.cache_key = None
+
+    def sampling_js(self, out):
+        """
+        Lines for the jsPsych timeline to repeat / randomise the table
+        """
+        random = self.order == "random"
+        if self.repeat != int(self.repeat):
+            self.context.write_once(REPEAT_JS, out)
+            random_js = "true" if random else "false"
+            return [f"""\
+sample: {{
+        type: "custom",
+        fn: function (indices) {{
+            return jspsych_repeat(indices, {self.repeat}, {random_js});
+        }}
+    }}"""]
+        repeat = int(self.repeat)
+        if random and repeat == 1:
+            return ["randomize_order: true"]
+        if random:
+            # shuffled across all repetitions, not within each
+            return [f'sample: {{type: "fixed-repetitions", size: {repeat}}}']
+        if repeat != 1:
+            return [f"repetitions: {repeat}"]
+        return []
+
+    def to_js(self, out):
+        write_tree(self, out)
 
-    def to_js(self):
-        super().to_js()
+    def js_steps(self, out):
+        super().to_js(out)
         # register variable names before we go into the timeline
-        for colname in self.table.column_names:
-            self.context.register_variable(colname)
-        code_str, timeline_str = build_timeline(
-            self.context, self.inner_timeline
+        self.context.enter_loop(self.table)
+        timeline_str = yield from build_timeline(
+            self.context, self.inner_timeline, out
         )
+        referenced = self.context.exit_loop()
+        colnames = self.table.column_names
+        if referenced is not None:
+            # only what the items inside look up, when translated or written
+            referenced |= self.referenced
+            colnames = [
+                colname for colname in colnames if colname in referenced
+            ]
         timeline_variables_name = self.get_unique_name(
             f"{self.name}_timeline_variables"
         )
-        table_contents = ',\n    '.join([
-            "{"+", ".join(f"{colname}: {repr(cell)}" for colname, cell in row)+"}"
-            for row in self.table
-        ])
-        for colname in self.table.column_names:
-            self.context.unregister_variable(colname)
-        return f"""\
-{code_str}
-
-var {timeline_variables_name} = [
-    {table_contents}
-];
+        instrumentation = self.context.instrumentation
+        if instrumentation is not None:
+            start_time = time.perf_counter()
+        self.write_table(timeline_variables_name, colnames, out)
+        if instrumentation is not None:
+            instrumentation.add_time("loop tables", start_time)
+            instrumentation.count("table cells", len(self.table) * len(colnames))
+            instrumentation.count(
+                "columns dropped", len(self.table.column_names) - len(colnames)
+            )
+        params = ",\n    ".join([
+            f"timeline: [{timeline_str}]",
+            f"timeline_variables: {timeline_variables_name}",
+        ] + self.sampling_js(out))
+        out.write(f"""\
 var {self.name} = {{
-    timeline: [{timeline_str}],
-    timeline_variables: {timeline_variables_name}
+    {params}
 }};
-"""
-        return result
+""")
+
+    def write_table(self, timeline_variables_name, colnames, out):
+        """
+        Writes the table, reusing the JS of an earlier translation if
+        possible: it only depends on the loop item and the columns written
+        """
+        if (
+            self.context.cache is None or self.cache_key is None
+            or len(self.table) * len(colnames) < CACHED_TABLE_CELLS
+        ):
+            self.table_to_js(timeline_variables_name, colnames, out)
+            return
+        table_files = self.context.table_files
+        def compute():
+            start = len(table_files)
+            string_out = io.StringIO()
+            self.table_to_js(timeline_variables_name, colnames, string_out)
+            # added below whether cached or not
+            urls = table_files[start:]
+            del table_files[start:]
+            return string_out.getvalue(), urls
+        def files_exist(cached):
+            # removed since, see OutputDirectory.prune
+            return all(
+                (self.context.output_dir / url).exists() for url in cached[1]
+            )
+        key = (
+            self.cache_key, "table", timeline_variables_name
+        ) + tuple(colnames)
+        js, urls = self.context.cached(key, compute, files_exist)
+        table_files.extend(urls)
+        out.write(js)
+
+    def table_to_js(self, timeline_variables_name, colnames, out):
+        if self.context.external_tables:
+            self.table_file_to_js(timeline_variables_name, colnames, out)
+        elif self.context.columnar_tables:
+            self.columns_to_js(timeline_variables_name, colnames, out)
+        else:
+            self.rows_to_js(timeline_variables_name, colnames, out)
+
+    def rows_to_js(self, timeline_variables_name, colnames, out):
+        out.write(f"\n\nvar {timeline_variables_name} = [\n    ")
+        if len(colnames) == len(self.table.column_names):
+            rows = self.table
+        else:
+            # the row count matters even if no columns are left
+            columns = [self.table[colname] for colname in colnames]
+            rows = (
+                zip(colnames, cells)
+                for cells in (zip(*columns) if columns else [()] * len(self.table))
+            )
+        # one row at a time, so the table is never held as a single string
+        for idx, row in enumerate(rows):
+            if idx > 0:
+                out.write(",\n    ")
+            out.write(
+                "{"+", ".join(f"{colname}: {js_value(cell)}" for colname, cell in row)+"}"
+            )
+        out.write("\n];\n")
+
+    def columns_to_js(self, timeline_variables_name, colnames, out):
+        out.write(
+            f"\n\nvar {timeline_variables_name} = jspsych_columns_to_rows("
+            f"{len(self.table)}, {{"
+        )
+        for idx, colname in enumerate(colnames):
+            if idx > 0:
+                out.write(",")
+            column = json.dumps(list(self.table[colname]), default=_json_default)
+            out.write(f"\n    {colname}: {column}")
+        out.write("\n});\n")
+
+    def table_file_to_js(self, timeline_variables_name, colnames, out):
+        # same layout as columns_to_js, so the same helper rebuilds the rows
+        data = {
+            "length": len(self.table),
+            "columns": {
+                colname: list(self.table[colname]) for colname in colnames
+            }
+        }
+        url = self.context.write_table_file(timeline_variables_name, data)
+        gzip_js = "true" if self.context.compress_tables else "false"
+        out.write(f"""
+
+var {timeline_variables_name} = [];
+jspsych_tables.push({{
+    url: "{url}",
+    target: {timeline_variables_name},
+    gzip: {gzip_js}
+}});
+""")
 
 class HTMLKeyboard(JSPsychProducer):
     """
     It looks odd that there's no visual stimulus here -- this is always set
     by a call-function "trial" from ChangeVisualStim
     """
+    __slots__ = ("keys_js", "duration")
+
     def __init__(
         self, _context, _name, keys=None, duration=None
     ):
         super().__init__(_context, _name)
-        self.keys = keys
+        # as JS straight away: many trials have the same keys, and this way
+        # they share one string
+        self.keys_js = "jsPsych.ALL_KEYS"
+        if isinstance(keys, list):
+            self.keys_js = self.context.shared_string(str(keys))
         self.duration = duration
         self.plugin = "html-keyboard-response"
 
-    def to_js(self):
-        super().to_js()
-        #print(self.name+" "+str(self.keys))
-        keys_js = "jsPsych.ALL_KEYS"
-        if isinstance(self.keys, list):
-            keys_js = str(self.keys)
+    def to_js(self, out):
+        super().to_js(out)
+        keys_js = self.keys_js
         duration_line = ""
         if self.duration is not None:
-            duration_line = "duration: "+self.context.sv(self.duration)+","
-        return f"""\
+            duration_line = "duration: "+self.context.sv(str(self.duration))+","
+        on_load_js = """\
+        if (jspsych_globals["current_postload_js"]) {
+            jspsych_globals["current_postload_js"]();
+        }
+"""
+        on_finish_line = ""
+        if self.context.telemetry:
+            # once drawn, see TELEMETRY_JS
+            on_load_js += "        jspsych_telemetry_start();\n"
+            requested = "null"
+            if self.duration is not None:
+                # as resolved for this trial; a bare timeline variable
+                # would only be a placeholder here
+                requested = "jsPsych.currentTrial().duration"
+            on_finish_line = (
+                "on_finish: function (data) { "
+                f"jspsych_telemetry_finish(data, {requested}); }},\n    "
+            )
+        out.write(f"""\
 var {self.name} = {{
     type: "html-keyboard-response",
     stimulus: function () {{ return jspsych_globals["current_visual"]; }},
+    on_load: function () {{
+{on_load_js}    }},
     {duration_line}
-    choices: {keys_js}
+    {on_finish_line}choices: {keys_js}
 }};
-"""
+""")
 
 class Comment(JSPsychProducer):
+    __slots__ = ("text",)
+
     def __init__(self, _context, _name, _text):
         super().__init__(_context, _name)
         self.text = _text
         self.context.comment_names.add(_name)
 
-    def to_js(self):
-        super().to_js()
-        return f"""\
+    def to_js(self, out):
+        super().to_js(out)
+        out.write(f"""\
 /*
 Auto-copied comment text from OpenSesame item {self.name}
 {self.text}
 */
-"""
+""")
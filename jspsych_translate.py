@@ -18,15 +18,98 @@ along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from pathlib import Path
+import threading
+import traceback
+import webbrowser
+
+from qtpy import QtCore, QtWidgets
 
 from libopensesame.py3compat import *
+from libopensesame.experiment import experiment as libopensesame_experiment
 from libqtopensesame.extensions import base_extension
+from libqtopensesame.misc.config import cfg
 from libqtopensesame.misc.translate import translation_context
 
-from opensesame_to_jspsych import opensesame_to_jspsych
+from instrumentation import Instrumentation
+from jspsych_objects import TranslationCancelled
+from opensesame_to_jspsych import Convertor
+from output import OutputDirectory
+from preview import PreviewServer
+from translation_cache import TranslationCache, script_hashes
+
+# after an edit, how long to wait for more before updating the preview
+PREVIEW_DELAY_MS = 300
 
 _ = translation_context(u'jspsych_translate', category=u'extension')
 
+class TranslationWorker(QtCore.QThread):
+
+    """
+    desc:
+        Translates and writes the experiment off the GUI thread, from a
+        snapshot of its script taken on the GUI thread, so editing the
+        experiment meanwhile can't change what is being translated. (For
+        previews, an edit while one runs just starts another afterwards.)
+    """
+
+    progress = QtCore.Signal(str, int, int)
+    succeeded = QtCore.Signal(str)
+    failed = QtCore.Signal(str)
+    cancelled = QtCore.Signal()
+
+    def __init__(
+        self, experiment, output_dir, options, zip_output=False, parent=None
+    ):
+
+        """
+        arguments:
+            experiment: the experiment, read here (on the GUI thread) and
+                not by the worker
+        """
+
+        super().__init__(parent)
+        self.script = experiment.to_string()
+        self.pool_folder = experiment.pool.folder()
+        self.experiment_path = experiment.experiment_path
+        self.output_dir = Path(output_dir)
+        self.options = options
+        self.zip_output = zip_output
+        self.cancel_event = threading.Event()
+        # whether any output file changed, once finished
+        self.changed = False
+
+    def run(self):
+
+        # files only change once complete, so a cancelled or failed
+        # translation leaves the last one intact
+        try:
+            experiment = libopensesame_experiment(
+                string=self.script, pool_folder=self.pool_folder,
+                experiment_path=self.experiment_path
+            )
+            output = OutputDirectory(self.output_dir)
+            # parsed from the snapshot, so only used here
+            convertor = Convertor(
+                experiment, owns_experiment=True, output_dir=self.output_dir,
+                progress=self.progress.emit, cancel_event=self.cancel_event,
+                item_hashes=script_hashes(self.script), **self.options
+            )
+            with output.open(u'experiment.js') as f:
+                html, _ = convertor.to_jspsych(f)
+            output.write_text(u'experiment.html', html)
+            # old tables only go once nothing refers to them
+            output.prune(u'tables', convertor.context.table_files)
+            self.changed = bool(output.changed)
+            summary = output.summary()
+            if self.zip_output:
+                summary += u', archived to %s' % output.zip()
+        except TranslationCancelled:
+            self.cancelled.emit()
+        except Exception:
+            self.failed.emit(traceback.format_exc())
+        else:
+            self.succeeded.emit(summary)
+
 class jspsych_translate(base_extension):
 
     """
@@ -37,6 +120,17 @@ class jspsych_translate(base_extension):
     def event_startup(self):
 
         self._widget = None
+        self._worker = None
+        self._progress = None
+        # set while previewing
+        self._preview = None
+        self._preview_pending = False
+        self._preview_timer = QtCore.QTimer()
+        self._preview_timer.setSingleShot(True)
+        self._preview_timer.setInterval(PREVIEW_DELAY_MS)
+        self._preview_timer.timeout.connect(self._preview_translate)
+        # kept for the session so re-translating skips unchanged items
+        self._cache = TranslationCache()
         self._jspsych_translate_action = self.qaction(
             u'applications-internet',
             u'JSPsychTranslate',
@@ -49,18 +143,206 @@ class jspsych_translate(base_extension):
             False,
             False
         )
+        self._jspsych_preview_action = self.qaction(
+            u'os-run-browser',
+            _(u'Preview jsPsych in browser'),
+            self._toggle_preview,
+            checkable=True,
+        )
+        self.add_action(
+            self.get_submenu(u'tools'),
+            self._jspsych_preview_action,
+            4,
+            False,
+            False
+        )
 
     def activate(self):
         pass
 
+    def _output_dir(self):
+
+        """
+        returns:
+            The directory to write to, from the jspsych_output_dir setting,
+            or asked for (and remembered) if that isn't set. None if the
+            user cancels.
+        """
+
+        if cfg.jspsych_output_dir:
+            return cfg.jspsych_output_dir
+        output_dir = QtWidgets.QFileDialog.getExistingDirectory(
+            self.main_window, _(u'Directory to write the jsPsych experiment to')
+        )
+        if not output_dir:
+            return None
+        cfg.jspsych_output_dir = output_dir
+        return output_dir
+
     def _do_translate(self):
-        experiment = self.main_window.experiment
-        start = self.main_window.experiment.var.start
-        self.console.write(start+"\n")
-        self.console.write(repr(experiment.items.items())+"\n")
-        html, js = opensesame_to_jspsych(experiment)
-        for text in [html, js, ""]:
-            self.console.write("-----------------------\n")
-            self.console.write(text+"\n")
-        open("/home/alisdair/jspsych_translate/out/experiment.html","w").write(html)
-        open("/home/alisdair/jspsych_translate/out/experiment.js","w").write(js)
+
+        if self._worker is not None:
+            # already translating
+            return
+        output_dir = self._output_dir()
+        if output_dir is None:
+            return
+        self._start_translation(output_dir, quiet=False)
+
+    def _start_translation(self, output_dir, quiet):
+
+        """
+        arguments:
+            quiet: for previews, with no progress dialog and no output in
+                the debug window unless something changed
+        """
+
+        self._quiet = quiet
+        self._instrumentation = Instrumentation()
+        self._worker = TranslationWorker(
+            self.main_window.experiment, output_dir, {
+                u'cache': self._cache,
+                u'instrumentation': self._instrumentation,
+                u'patch_cache_dir':
+                    Path.home() / u'.opensesame_to_jspsych' / u'patches',
+            },
+            zip_output=bool(cfg.jspsych_zip_output),
+            parent=self.main_window
+        )
+        if not quiet:
+            self._progress = QtWidgets.QProgressDialog(
+                _(u'Translating to jsPsych'), _(u'Cancel'), 0, 0,
+                self.main_window
+            )
+            self._progress.setWindowModality(QtCore.Qt.WindowModal)
+            self._progress.setMinimumDuration(500)
+            self._progress.canceled.connect(self._worker.cancel_event.set)
+            self._worker.progress.connect(self._on_progress)
+        self._worker.succeeded.connect(self._on_succeeded)
+        self._worker.failed.connect(self._on_failed)
+        self._worker.cancelled.connect(self._on_cancelled)
+        self._worker.finished.connect(self._on_finished)
+        self._worker.start()
+
+    def _on_progress(self, stage, done, total):
+
+        self._progress.setLabelText(_(u'%s item %d of %d') % (stage, done, total))
+        self._progress.setMaximum(total)
+        self._progress.setValue(done)
+
+    def _on_succeeded(self, summary):
+
+        if self._preview is not None:
+            if not self._preview_opened:
+                webbrowser.open(self._preview.url)
+                self._preview_opened = True
+            elif self._worker.changed:
+                self._preview.reload()
+        if self._quiet and not self._worker.changed:
+            return
+        output_dir = self._worker.output_dir
+        self.console.write(
+            _(u'jsPsych experiment written to %s: %s\n') % (output_dir, summary)
+        )
+        # a bounded look at the output; 0 turns this off, as large
+        # experiments are slow to show
+        chars = int(cfg.jspsych_console_chars)
+        if chars > 0:
+            for name in (u'experiment.html', u'experiment.js'):
+                with open(Path(output_dir) / name, encoding=u'utf-8') as f:
+                    text = f.read(chars + 1)
+                if len(text) > chars:
+                    text = text[:chars] + u'\n[...]'
+                self.console.write(u'-----------------------\n')
+                self.console.write(text + u'\n')
+        self.console.write(self._instrumentation.format() + u'\n')
+
+    def _on_failed(self, message):
+
+        self.console.write(message)
+        if self._quiet:
+            # an edit in progress may not translate; the next one might
+            return
+        QtWidgets.QMessageBox.warning(
+            self.main_window, _(u'jsPsych translation failed'),
+            message.strip().splitlines()[-1]
+        )
+
+    def _on_cancelled(self):
+
+        self.console.write(_(u'jsPsych translation cancelled\n'))
+
+    def _on_finished(self):
+
+        if self._progress is not None:
+            self._progress.close()
+            self._progress = None
+        self._worker.deleteLater()
+        self._worker = None
+        if self._preview_pending:
+            self._preview_pending = False
+            self._preview_timer.start()
+
+    def _toggle_preview(self):
+
+        """
+        desc:
+            Starts serving the output directory on localhost, translating
+            the experiment again after each edit and reloading the browser,
+            or stops.
+        """
+
+        if self._preview is not None:
+            self._preview_timer.stop()
+            self._preview.stop()
+            self._preview = None
+            self._jspsych_preview_action.setChecked(False)
+            self.console.write(_(u'jsPsych preview stopped\n'))
+            return
+        output_dir = self._output_dir()
+        if output_dir is None:
+            self._jspsych_preview_action.setChecked(False)
+            return
+        self._preview = PreviewServer(output_dir)
+        self._preview.start()
+        self._preview_opened = False
+        self._preview_dir = output_dir
+        self.console.write(
+            _(u'jsPsych preview at %s\n') % self._preview.url
+        )
+        self._preview_changed()
+
+    def _preview_changed(self):
+
+        if self._preview is not None:
+            # restarts the wait if already waiting
+            self._preview_timer.start()
+
+    def _preview_translate(self):
+
+        if self._preview is None:
+            return
+        if self._worker is not None:
+            self._preview_pending = True
+            return
+        self._start_translation(self._preview_dir, quiet=True)
+
+    def event_change_experiment(self):
+
+        self._preview_changed()
+
+    def event_change_item(self, name):
+
+        self._preview_changed()
+
+    def event_rename_item(self, from_name, to_name):
+
+        self._preview_changed()
+
+    def event_new_item(self, name, _type):
+
+        self._preview_changed()
+
+    def event_delete_item(self, name):
+
+        self._preview_changed()
@@ -1,63 +1,200 @@
 # Takes a libopensesame.experiment.experiment
 # Returns jsPsych as text
 
+import io
 from pathlib import Path
+import time
 
-from libqtopensesame.items.keyboard_response import keyboard_response
-from libqtopensesame.items.loop import loop
-from libqtopensesame.items.sequence import sequence
-from libqtopensesame.items.sketchpad import sketchpad
-
+from instrumentation import CountingWriter
 from jspsych_objects import *
 from sketchpad_to_html import SketchpadTranslator
+from translation_cache import item_hash
 
 def clean_type(t):
     return repr(type(t)).replace('<','').replace('>','')
 
+def item_type(item):
+    """
+    Items are told apart by class name rather than class, so that both the
+    GUI (libqtopensesame) and runtime (libopensesame) versions are handled
+    and translation works without Qt
+    """
+    return type(item).__name__
+
 class Convertor(object):
-    def __init__(self, experiment):
+    def __init__(self, experiment, owns_experiment=False, **options):
+        """
+        owns_experiment: nothing else uses the experiment, so with
+         compact_tables each loop table is emptied as it is copied, and the
+         two are never both held in full. The experiment can't be used
+         afterwards.
+        options are passed on to TranslationContext
+        """
+        # names of the items being translated, outermost first, and as a
+        # set to find cycles quickly
         self.item_stack = []
+        self._items_in_progress = set()
+        # name: hash, found once per translation; see item_key
+        self._item_keys = {}
+        # loop name: its ColumnTable, with compact_tables
+        self._column_tables = {}
+        self.owns_experiment = owns_experiment
         self.exp = experiment
         self.items = experiment.items
         self.start = experiment.var.start
         self.current_visual = None
-        self.context = TranslationContext()
+        self.context = TranslationContext(**options)
+        self.context.pool = getattr(experiment, "pool", None)
 
-    def to_jspsych(self):
+    def to_jspsych(self, out=None):
+        """
+        If out (e.g. an open file) is given the JS is written to it as it is
+        generated and None is returned in place of the JS text.
+        """
         # assert that start is a sequence
-        assert type(self.items[self.start]) == sequence, "Start of experiment must be a sequence"
+        assert item_type(self.items[self.start]) == "sequence", "Start of experiment must be a sequence"
+        instrumentation = self.context.instrumentation
+        if instrumentation is not None:
+            start_time = time.perf_counter()
+        self.item_stack.append(self.start)
+        self._items_in_progress.add(self.start)
         top_sequence = self.sequence_to_jspsych(self.start, init=True)[0]
+        self.item_stack.pop()
+        self._items_in_progress.remove(self.start)
+        if self.context.compact_tables:
+            self.release_experiment()
+        if instrumentation is not None:
+            instrumentation.add_time("build tree", start_time)
+            start_time = time.perf_counter()
+        string_out = None
+        final_out = out
+        # the bundle needs all the JS; it is written to out afterwards
+        if out is None or self.context.bundle:
+            out = string_out = io.StringIO()
+        if instrumentation is not None:
+            out = CountingWriter(out, instrumentation)
         # do JS first as plugins are collected on the way
-        js = top_sequence.to_js()
+        top_sequence.to_js(out)
+        if instrumentation is not None:
+            instrumentation.add_time("emit", start_time)
+        js = None if string_out is None else string_out.getvalue()
+        if self.context.bundle:
+            if instrumentation is not None:
+                start_time = time.perf_counter()
+            self.context.write_bundle(js)
+            if instrumentation is not None:
+                instrumentation.add_time("bundle", start_time)
+            if final_out is not None:
+                final_out.write(js)
+                js = None
         return self.context.generate_html(), js
 
+    def release_experiment(self):
+        """
+        Drops references to the experiment once translated; with
+        compact_tables nothing written after that needs it
+        """
+        self.exp = self.items = None
+        self.context.pool = None
+
+    def translate(self, steps):
+        """
+        Runs steps, a generator from one of the *_steps methods, and
+        returns its result. These yield (item name, condition) for each
+        item inside them and are sent back its translation, so however
+        deeply items are nested the Python stack doesn't grow.
+        """
+        stack = [steps]
+        value = None
+        while stack:
+            try:
+                request = stack[-1].send(value)
+            except StopIteration as stop:
+                stack.pop()
+                value = stop.value
+            else:
+                stack.append(self.item_steps(*request))
+                value = None
+        return value
+
     def sequence_to_jspsych(self, seq_item_name, condition="always", init=False):
+        return self.translate(
+            self.sequence_steps(seq_item_name, condition, init)
+        )
+
+    def sequence_steps(self, seq_item_name, condition="always", init=False):
         seq_item = self.items[seq_item_name]
         timeline_items = []
-        for item, cond in seq_item.items:
-            jsp_item = self.item_to_jspsych(item, condition=cond)
+        for idx, (item, cond) in enumerate(seq_item.items):
+            if self.context.optimize and str(cond).strip() == "never":
+                # never run, so leave it out
+                jsp_item = None
+            else:
+                jsp_item = yield (item, cond)
             if jsp_item is not None:
                 if isinstance(jsp_item, list):
                     timeline_items += jsp_item
                 else:
                     timeline_items.append(jsp_item)
+            if init:
+                self.context.report_progress(
+                    "Translating", idx + 1, len(seq_item.items)
+                )
         return [Timeline(self.context, seq_item_name, timeline_items, _init=init)]
 
     def item_to_jspsych(self, item_name, condition="always"):
+        return self.translate(self.item_steps(item_name, condition))
+
+    def item_steps(self, item_name, condition="always"):
+        self.context.check_cancelled()
+        if item_name in self._items_in_progress:
+            path = " > ".join(self.item_stack + [item_name])
+            raise Exception(f"Item {item_name} contains itself: {path}")
+        self.item_stack.append(item_name)
+        self._items_in_progress.add(item_name)
+        instrumentation = self.context.instrumentation
+        if instrumentation is not None:
+            start_time = time.perf_counter()
+        result = yield from self._item_steps(item_name, condition)
+        if instrumentation is not None:
+            type_name = item_type(self.items[item_name])
+            instrumentation.add_time(f"translate {type_name}", start_time)
+            instrumentation.count(f"{type_name} items")
+        self.item_stack.pop()
+        self._items_in_progress.remove(item_name)
+        return result
+
+    def _item_steps(self, item_name, condition):
         item = self.items[item_name]
-        if type(item) == sequence:
-            return self.sequence_to_jspsych(item_name, condition)
-        elif type(item) == loop:
-            return self.loop_to_jspsych(item_name, condition)
-        elif type(item) == sketchpad:
-            return self.sketchpad_to_jspsych(item_name, condition)
-        elif type(item) == keyboard_response:
-            return self.keyboard_to_jspsych(item_name, condition)
+        if item_type(item) == "sequence":
+            return (yield from self.sequence_steps(item_name, condition))
+        elif item_type(item) == "loop":
+            return (yield from self.loop_steps(item_name, condition))
+        elif item_type(item) == "sketchpad":
+            result = self.sketchpad_to_jspsych(item_name, condition)
+        elif item_type(item) == "keyboard_response":
+            result = self.keyboard_to_jspsych(item_name, condition)
         elif 'notepad' in item.__class__.__name__:
             # horrible way to detect but not sure what else would work ....
-            return self.notepad_to_jspsych(item_name, condition)
+            result = self.notepad_to_jspsych(item_name, condition)
         else:
-            return self.filler_to_jspsych(item_name, condition)
+            result = self.filler_to_jspsych(item_name, condition)
+        return result
+
+    def item_key(self, item_name):
+        """
+        Hash of the item for cache keys: from the item_hashes option if
+        given, otherwise of its script
+        """
+        key = self._item_keys.get(item_name)
+        if key is None:
+            item_hashes = self.context.item_hashes
+            if item_hashes is not None and item_name in item_hashes:
+                key = item_hashes[item_name]
+            else:
+                key = item_hash(self.items[item_name])
+            self._item_keys[item_name] = key
+        return key
 
     def sketchpad_to_jspsych(self, spad_item_name, condition="always"):
         """
@@ -74,9 +211,43 @@ class Convertor(object):
         result = []
         spad_item = self.items[spad_item_name]
         elements = spad_item.elements
-        js, html = SketchpadTranslator(self.context, elements).to_js()
+        translator = SketchpadTranslator(self.context, elements)
+        def translate():
+            js, html = translator.to_js()
+            return js, html, translator.prerender_js, translator.assets
+        def translate_recorded():
+            return self.context.recorded(translate)
+        instrumentation = self.context.instrumentation
+        if instrumentation is not None:
+            start_time = time.perf_counter()
+        if self.context.cache is None:
+            js, html, prerender_js, assets = translate()
+        else:
+            key = ("sketchpad", self.item_key(spad_item_name)) + self.context.variables_key()
+            if translator.uses_loop_tables():
+                # patches and images are added for the values in the loop
+                # tables
+                key += self.context.loop_tables_key()
+            def assets_unchanged(cached):
+                # adds them, as they haven't been seen in this translation;
+                # if a file has changed its URL has too
+                (_, _, _, assets), _ = cached
+                return all(
+                    getattr(self.context.assets, method)(*args) == url
+                    for method, args, url in assets
+                )
+            translation, referenced = self.context.cached(
+                key, translate_recorded, assets_unchanged
+            )
+            js, html, prerender_js, assets = translation
+            # if cached, the variables haven't been seen in this translation
+            self.context.replay(referenced)
+        if instrumentation is not None:
+            instrumentation.add_time("sketchpad code", start_time)
+            instrumentation.count("sketchpad elements", len(elements))
         result.append(ChangeVisualStim(
-            self.context, spad_item_name+"_visual", html, js, condition
+            self.context, spad_item_name+"_visual", html, js, condition,
+            prerender_js
         ))
         duration_in = spad_item.var.duration.strip()
         try:
@@ -107,19 +278,72 @@ class Convertor(object):
         return result
 
     def loop_to_jspsych(self, loop_item_name, condition="always"):
+        return self.translate(self.loop_steps(loop_item_name, condition))
+
+    def loop_steps(self, loop_item_name, condition="always"):
         loop_item = self.items[loop_item_name]
+        repeat = self.loop_repeat(loop_item_name)
+        if repeat == 0:
+            # never runs, so leave it out
+            return []
+        # its table only depends on the loop item, so can be cached; found
+        # before the table is emptied
+        cache_key = None
+        if self.context.cache is not None:
+            cache_key = self.item_key(loop_item_name)
         dm = loop_item.dm
+        if self.context.compact_tables:
+            # once emptied, a loop run twice uses the same copy
+            if loop_item_name not in self._column_tables:
+                self._column_tables[loop_item_name] = ColumnTable(
+                    dm, self.context.shared_string,
+                    release=self.owns_experiment
+                )
+                if self.owns_experiment:
+                    loop_item.dm = None
+            dm = self._column_tables[loop_item_name]
         inner_item_name = loop_item._item
-        return [
-            Loop(
-                self.context,
-                loop_item_name,
-                self.item_to_jspsych(inner_item_name), # *
-                dm
-            )
-        ]
+        # loop variables can be used by the items inside (e.g. sketchpads)
+        self.context.enter_loop(dm)
+        inner_timeline = yield (inner_item_name, "always") # *
+        referenced = self.context.exit_loop()
+        order = str(loop_item.var.get("order", "sequential"))
+        result = Loop(
+            self.context, loop_item_name, inner_timeline, dm,
+            repeat=repeat, order=order, referenced=referenced
+        )
+        result.cache_key = cache_key
+        return [result]
         # * Needs to be a list -- but all *_to_jspsych functions return lists
 
+    def loop_repeat(self, loop_item_name):
+        """
+        How many times the loop's table is run through, from its repeat (or
+        in older experiments cycles) setting. Only fixed numbers can be
+        translated, as jsPsych needs the number when the timeline is built.
+        """
+        loop_item = self.items[loop_item_name]
+        setting = "repeat"
+        value = loop_item.var.get("repeat", None)
+        if value is None:
+            # older experiments give the number of cycles instead
+            setting = "cycles"
+            value = loop_item.var.get("cycles", None)
+            if value is None:
+                return 1.0
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise Exception(
+                f"Loop {loop_item_name} has {setting} {value!r}; only a fixed number can be translated"
+            )
+        if number < 0 or number != number or number == float("inf"):
+            raise Exception(f"Loop {loop_item_name} has {setting} {value!r}")
+        if setting == "cycles":
+            rows = len(loop_item.dm)
+            return 1.0 if rows == 0 else number / rows
+        return number
+
     def keyboard_to_jspsych(self, kbd_item_name, condition="always"):
         kbd_item = self.items[kbd_item_name]
         allowed_responses = kbd_item.var.allowed_responses.split(";")
@@ -139,7 +363,15 @@ class Convertor(object):
             HTMLKeyboard(self.context, item_name)
         ]
 
-def opensesame_to_jspsych(experiment):
-    c = Convertor(experiment)
-    html, js = c.to_jspsych()
-    return (html, js)
+def opensesame_to_jspsych(experiment, **options):
+    out = io.StringIO()
+    html = write_jspsych(experiment, out, **options)
+    return (html, out.getvalue())
+
+def write_jspsych(experiment, out, **options):
+    """
+    Streams the experiment JS to out, returns the HTML
+    """
+    c = Convertor(experiment, **options)
+    html, _ = c.to_jspsych(out)
+    return html
@@ -0,0 +1,141 @@
+# Writing the translated experiment to disk: files only change once they
+# are complete, and only if their contents have
+
+from contextlib import contextmanager
+import hashlib
+import os
+from pathlib import Path
+import threading
+import zipfile
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def same_contents(path1, path2):
+    return (
+        os.path.getsize(path1) == os.path.getsize(path2)
+        and file_hash(path1) == file_hash(path2)
+    )
+
+@contextmanager
+def atomic_write(path, mode="w", encoding="utf-8"):
+    """
+    Yields a file to write the new contents of path to. They are written to
+    a temporary file alongside, which replaces path once the block ends.
+    If the block raises, path is left as it was.
+    If the contents are the same as path's, path isn't touched, so its
+    modification time stays the same; the yielded AtomicFile's changed
+    attribute says which happened.
+    """
+    path = Path(path)
+    temp_path = path.with_name(
+        f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    if "b" in mode:
+        encoding = None
+    try:
+        with open(temp_path, mode, encoding=encoding) as f:
+            result = AtomicFile(f)
+            yield result
+        if path.exists() and same_contents(temp_path, path):
+            temp_path.unlink()
+        else:
+            os.replace(temp_path, path)
+            result.changed = True
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+class AtomicFile:
+    """
+    The file atomic_write yields: write to it as to any file, then check
+    changed once the with block has ended
+    """
+    def __init__(self, f):
+        self.file = f
+        self.changed = False
+
+    def write(self, text):
+        return self.file.write(text)
+
+class OutputDirectory:
+    """
+    Writes files to path with atomic_write, remembering which changed, e.g.
+
+        output = OutputDirectory("out")
+        convertor = Convertor(experiment, output_dir=output.path)
+        with output.open("experiment.js") as f:
+            html, _ = convertor.to_jspsych(f)
+        output.write_text("experiment.html", html)
+        output.prune("tables", convertor.context.table_files)
+        output.zip()
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.changed = []
+        self.unchanged = []
+        self.removed = []
+
+    @contextmanager
+    def open(self, name, mode="w"):
+        with atomic_write(self.path / name, mode) as f:
+            yield f
+        (self.changed if f.changed else self.unchanged).append(name)
+
+    def write_text(self, name, text):
+        with self.open(name) as f:
+            f.write(text)
+
+    def prune(self, subdir, keep):
+        """
+        Removes the files in path/subdir other than keep (names relative to
+        path, e.g. "tables/lp.0123456789ab.json"). Call once the files
+        referring to them have been written, so a failed or cancelled
+        translation never leaves the last one without its files.
+        """
+        directory = self.path / subdir
+        if not directory.is_dir():
+            return
+        keep = {(self.path / name).resolve() for name in keep}
+        for path in sorted(directory.iterdir()):
+            if (
+                path.is_file() and not path.name.endswith(".tmp")
+                and path.resolve() not in keep
+            ):
+                path.unlink()
+                self.removed.append(path.relative_to(self.path).as_posix())
+
+    def zip(self, zip_path=None):
+        """
+        Archives everything in the directory (default: to a .zip of the
+        same name alongside it), for uploading in one go. Files are added
+        in name order with a fixed timestamp, so the archive only changes
+        when they do. Returns the archive's path.
+        """
+        zip_path = self.path.with_suffix(".zip") if zip_path is None else Path(zip_path)
+        paths = sorted(
+            path for path in self.path.rglob("*")
+            if path.is_file() and not path.name.endswith(".tmp")
+            and path.resolve() != zip_path.resolve()
+        )
+        with atomic_write(zip_path, "wb") as f:
+            with zipfile.ZipFile(f.file, "w", zipfile.ZIP_DEFLATED) as archive:
+                for path in paths:
+                    info = zipfile.ZipInfo(
+                        path.relative_to(self.path).as_posix(),
+                        date_time=(1980, 1, 1, 0, 0, 0)
+                    )
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    archive.writestr(info, path.read_bytes())
+        return zip_path
+
+    def summary(self):
+        summary = f"{len(self.changed)} file(s) written, {len(self.unchanged)} unchanged"
+        if self.removed:
+            summary += f", {len(self.removed)} removed"
+        return summary
@@ -0,0 +1,181 @@
+# Gabor and noise patches, rendered to PNG at translation time so the
+# browser only has to draw an image
+
+import hashlib
+from pathlib import Path
+import re
+import struct
+import zlib
+
+from output import atomic_write
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# a few of the colour names OpenSesame accepts
+COLOURS = {
+    "black": (0, 0, 0), "white": (255, 255, 255), "red": (255, 0, 0),
+    "lime": (0, 255, 0), "green": (0, 128, 0), "blue": (0, 0, 255),
+    "yellow": (255, 255, 0), "cyan": (0, 255, 255),
+    "magenta": (255, 0, 255), "gray": (128, 128, 128),
+    "grey": (128, 128, 128), "silver": (192, 192, 192),
+    "maroon": (128, 0, 0), "olive": (128, 128, 0), "navy": (0, 0, 128),
+    "purple": (128, 0, 128), "teal": (0, 128, 128), "orange": (255, 165, 0),
+}
+
+def parse_colour(colour):
+    """
+    (r, g, b) from a name, #rgb, #rrggbb, rgb(r,g,b) or a grey level 0-255
+    """
+    text = str(colour).strip().lower()
+    if text in COLOURS:
+        return COLOURS[text]
+    if re.match(r"^#[0-9a-f]{6}$", text):
+        return tuple(int(text[idx:idx+2], 16) for idx in (1, 3, 5))
+    if re.match(r"^#[0-9a-f]{3}$", text):
+        return tuple(int(text[idx] * 2, 16) for idx in (1, 2, 3))
+    m = re.match(r"^rgb\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\)$", text)
+    if m is not None:
+        return tuple(int(value) for value in m.groups())
+    if text.isnumeric():
+        return (int(text),) * 3
+    raise Exception(f"Unknown colour for gabor/noise patch: {colour}")
+
+# names OpenSesame accepts for each envelope, as in its _match_env
+ENVELOPES = {
+    "c": ("c", "circular", "round"),
+    "g": ("g", "gaussian", "gauss", "normal"),
+    "l": ("l", "linear", "lin", "ln"),
+    "r": ("r", "rectangular", "rect", "rectangle"),
+}
+
+def match_env(env):
+    """
+    "c", "g", "l" or "r" for any name OpenSesame accepts for an envelope
+    """
+    text = str(env).strip().lower()
+    for short, names in ENVELOPES.items():
+        if text in names:
+            return short
+    raise Exception(f"Unknown envelope for gabor/noise patch: {env}")
+
+def envelope(env, size, stdev, dx, dy):
+    """
+    Opacity of the patch (0 to 1) at offsets dx, dy from its centre
+    """
+    r = np.sqrt(dx ** 2 + dy ** 2)
+    env = match_env(env)
+    if env == "c": # circular
+        return (r <= 0.5 * size).astype(float)
+    if env == "l": # linear
+        return np.maximum(0, (0.5 * size - r) / (0.5 * size))
+    if env == "r": # rectangular
+        return np.ones_like(r)
+    # gaussian
+    return np.exp(-0.5 * (dx / stdev) ** 2 - 0.5 * (dy / stdev) ** 2)
+
+def blend(f, e, color1, color2, bgmode):
+    """
+    Mixes color1 and color2 by f (0 to 1), over the background by e
+    """
+    c1 = np.array(parse_colour(color1), dtype=float)
+    c2 = np.array(parse_colour(color2), dtype=float)
+    bg = (c1 + c2) / 2 if bgmode == "avg" else c2
+    f = f[..., np.newaxis]
+    e = e[..., np.newaxis]
+    rgb = c1 * f * e + c2 * (1 - f) * e + bg * (1 - e)
+    return np.clip(np.round(rgb), 0, 255).astype(np.uint8)
+
+def offsets(size):
+    half = 0.5 * size
+    dy, dx = np.mgrid[0:size, 0:size]
+    return dx - half, dy - half
+
+def render_gabor(orient, freq, env, size, stdev, phase, color1, color2, bgmode):
+    """
+    As OpenSesame draws them: freq in cycles per pixel, phase in cycles,
+    orient in degrees
+    """
+    dx, dy = offsets(size)
+    t = np.arctan2(dy, dx) + np.radians(orient)
+    r = np.sqrt(dx ** 2 + dy ** 2)
+    x = r * np.cos(t)
+    f = 0.5 + 0.5 * np.cos(2 * np.pi * (freq * x + phase))
+    return blend(f, envelope(env, size, stdev, dx, dy), color1, color2, bgmode)
+
+def render_noise(env, size, stdev, color1, color2, bgmode, seed):
+    """
+    OpenSesame draws new noise each time; here seed fixes it, so the patch
+    can be cached
+    """
+    dx, dy = offsets(size)
+    f = np.random.RandomState(seed).random_sample((size, size))
+    return blend(f, envelope(env, size, stdev, dx, dy), color1, color2, bgmode)
+
+def png_bytes(rgb):
+    """
+    PNG file contents for an (height, width, 3) uint8 array
+    """
+    height, width, _ = rgb.shape
+    # each row starts with filter type 0 (none)
+    rows = np.concatenate(
+        [np.zeros((height, 1), dtype=np.uint8), rgb.reshape(height, width * 3)],
+        axis=1
+    )
+    def chunk(tag, data):
+        return (
+            struct.pack(">I", len(data)) + tag + data +
+            struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+        )
+    return (
+        b"\x89PNG\r\n\x1a\n" +
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+        chunk(b"IDAT", zlib.compress(rows.tobytes(), 9)) +
+        chunk(b"IEND", b"")
+    )
+
+# changed whenever patches are rendered differently, so those cached on disk
+# by an earlier version aren't used
+RENDER_VERSION = 2
+
+class PatchRenderer:
+    """
+    Renders patches to PNG, keeping each one (keyed by its parameters) in
+    memory and, with cache_dir, on disk, so a patch is only ever computed
+    once across translations
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self._pngs = {}
+
+    def png(self, kind, **params):
+        """
+        kind: "gabor" or "noise"; params as for render_gabor/render_noise
+        """
+        if np is None:
+            raise Exception("Translating gabor and noise elements needs NumPy")
+        # so each name for an envelope renders the same patch
+        params["env"] = match_env(params["env"])
+        key = hashlib.sha1(
+            repr((RENDER_VERSION, kind, sorted(params.items()))).encode("utf-8")
+        ).hexdigest()
+        content = self._pngs.get(key)
+        if content is not None:
+            return content
+        path = None if self.cache_dir is None else self.cache_dir / f"{key}.png"
+        if path is not None and path.exists():
+            content = path.read_bytes()
+        else:
+            if kind == "gabor":
+                rgb = render_gabor(**params)
+            else:
+                rgb = render_noise(**params)
+            content = png_bytes(rgb)
+            if path is not None:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                with atomic_write(path, "wb") as f:
+                    f.write(content)
+        self._pngs[key] = content
+        return content
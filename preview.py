@@ -0,0 +1,264 @@
+"""
+Serves a translated experiment on localhost, retranslating it when it
+changes and reloading the browsers showing it, e.g.
+
+    python preview.py experiment.osexp
+
+The GUI extension uses PreviewServer in the same way (Tools > Preview in
+browser).
+"""
+
+import argparse
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import sys
+import threading
+import time
+import traceback
+import webbrowser
+
+# added to every HTML page served, to reload it when told to
+RELOAD_SCRIPT = """\
+<script>
+new EventSource("/__reload").onmessage = function () {
+    location.reload();
+};
+</script>
+"""
+
+class PreviewRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the output directory, never to be cached, with RELOAD_SCRIPT in
+    HTML pages and server-sent events at /__reload
+    """
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/__reload":
+            self.send_reload_events()
+            return
+        if path == "/":
+            self.send_response(302)
+            self.send_header("Location", "/experiment.html")
+            self.end_headers()
+            return
+        if path.endswith(".html"):
+            self.send_html(Path(self.translate_path(path)))
+            return
+        super().do_GET()
+
+    def end_headers(self):
+        self.send_header("Cache-Control", "no-store")
+        super().end_headers()
+
+    def send_html(self, path):
+        if not path.is_file():
+            self.send_error(404)
+            return
+        html = path.read_text(encoding="utf-8")
+        if "</body>" in html:
+            html = html.replace("</body>", RELOAD_SCRIPT + "</body>", 1)
+        else:
+            html += RELOAD_SCRIPT
+        content = html.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_reload_events(self):
+        server = self.server
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        version = server.version
+        try:
+            while True:
+                with server.changed:
+                    server.changed.wait_for(
+                        lambda: server.version != version or server.stopping,
+                        timeout=15
+                    )
+                if server.stopping:
+                    return
+                if server.version != version:
+                    version = server.version
+                    self.wfile.write(b"data: reload\n\n")
+                else:
+                    # keeps the connection open through proxies
+                    self.wfile.write(b": waiting\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the page was closed or reloaded
+            return
+
+    def log_message(self, format, *args):
+        pass
+
+class PreviewServer:
+    """
+    Serves directory on localhost from a background thread. Call reload()
+    after the files change to reload every page showing them.
+    port 0 picks a free port; see url.
+    """
+    def __init__(self, directory, port=0):
+        handler = partial(PreviewRequestHandler, directory=str(directory))
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.version = 0
+        self.httpd.stopping = False
+        self.httpd.changed = threading.Condition()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/experiment.html"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True
+        )
+        self._thread.start()
+
+    def reload(self):
+        with self.httpd.changed:
+            self.httpd.version += 1
+            self.httpd.changed.notify_all()
+
+    def stop(self):
+        with self.httpd.changed:
+            self.httpd.stopping = True
+            self.httpd.changed.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class Debouncer:
+    """
+    Calls func (in another thread) once delay seconds have passed without
+    another call to trigger, so a burst of changes gives one rebuild
+    """
+    def __init__(self, delay, func):
+        self.delay = delay
+        self.func = func
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def trigger(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self.func)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def cancel(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+class Rebuilder:
+    """
+    Runs build (returning whether any output file changed) debounced and
+    one at a time, reloading the server's pages if anything changed
+    """
+    def __init__(self, build, server, delay=0.3):
+        self.build = build
+        self.server = server
+        self.debouncer = Debouncer(delay, self.rebuild)
+        self._lock = threading.Lock()
+
+    def changed(self):
+        self.debouncer.trigger()
+
+    def rebuild(self):
+        with self._lock:
+            start_time = time.perf_counter()
+            try:
+                changed = self.build()
+            except Exception:
+                traceback.print_exc()
+                return
+            seconds = time.perf_counter() - start_time
+        if changed:
+            print(f"Rebuilt in {seconds:.2f}s, reloading")
+            self.server.reload()
+        else:
+            print(f"Rebuilt in {seconds:.2f}s, no change")
+
+def translator(experiment_path, output_dir, options):
+    """
+    A build function for Rebuilder, translating the experiment file into
+    output_dir. Translations share a cache, so only changed items are
+    translated again.
+    """
+    from batch_translate import load_experiment
+    from opensesame_to_jspsych import Convertor
+    from output import OutputDirectory
+    from translation_cache import TranslationCache, script_hashes
+    cache = TranslationCache()
+    def build():
+        output = OutputDirectory(output_dir)
+        experiment = load_experiment(experiment_path)
+        convertor = Convertor(
+            experiment, owns_experiment=True, output_dir=output_dir, cache=cache,
+            item_hashes=script_hashes(experiment.to_string()), **options
+        )
+        with output.open("experiment.js") as f:
+            html, _ = convertor.to_jspsych(f)
+        output.write_text("experiment.html", html)
+        output.prune("tables", convertor.context.table_files)
+        return bool(output.changed)
+    return build
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Preview an OpenSesame experiment as jsPsych, "
+        "updating it as the file changes"
+    )
+    parser.add_argument("experiment", type=Path, help=".osexp file")
+    parser.add_argument("-o", "--output", type=Path, default=None,
+        help="directory to translate to (default: preview/<experiment name>)")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--delay", type=float, default=0.3,
+        help="seconds to wait after a change before translating")
+    parser.add_argument("--no-browser", action="store_true",
+        help="don't open a browser")
+    args = parser.parse_args(argv)
+    output_dir = args.output
+    if output_dir is None:
+        output_dir = Path("preview") / args.experiment.stem
+
+    build = translator(args.experiment, output_dir, {})
+    # served even if the first build fails; fixing the file rebuilds it
+    output_dir.mkdir(parents=True, exist_ok=True)
+    server = PreviewServer(output_dir, args.port)
+    rebuilder = Rebuilder(build, server, args.delay)
+    rebuilder.rebuild()
+    server.start()
+    print(f"Serving {server.url} (Ctrl+C to stop)")
+    if not args.no_browser:
+        webbrowser.open(server.url)
+    mtime = args.experiment.stat().st_mtime_ns
+    try:
+        while True:
+            time.sleep(0.1)
+            try:
+                new_mtime = args.experiment.stat().st_mtime_ns
+            except FileNotFoundError:
+                # being saved
+                continue
+            if new_mtime != mtime:
+                mtime = new_mtime
+                rebuilder.changed()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rebuilder.debouncer.cancel()
+        server.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,95 +1,343 @@
-from libopensesame.sketchpad_elements import *
+import hashlib
+import json
 
-# TODO: use context to translate vars
+from jspsych_objects import compile_text
+
+CANVAS_JS = """\
+const canvas = document.getElementById("sketchpad");
+const ctx = canvas.getContext("2d");
+"""
+
+DEFAULTS_JS = """\
+// defaults
+ctx.textAlign = "center";
+ctx.textBaseline = "middle";
+"""
+
+# element properties used to render patches, see draw_patch
+PATCH_PARAMS = {
+    "gabor": (
+        "orient", "freq", "env", "size", "stdev", "phase", "color1",
+        "color2", "bgmode"
+    ),
+    "noise": ("env", "size", "stdev", "color1", "color2", "bgmode"),
+}
+PATCH_PARAM_TYPES = {
+    "orient": float, "freq": float, "stdev": float, "phase": float,
+    "size": lambda value: int(float(value)),
+}
+
+def substitute(value, values_by_name):
+    """
+    value with its variables replaced by values_by_name
+    """
+    tokens = compile_text(str(value).strip()).tokens
+    if len(tokens) == 1 and tokens[0][0]:
+        return values_by_name[tokens[0][1]]
+    return "".join(
+        str(values_by_name[text]) if is_var else text
+        for is_var, text in tokens
+    )
+
+def patch_key(values):
+    """
+    What JSON.stringify gives for the same values in the browser
+    """
+    normalised = []
+    for value in values:
+        if hasattr(value, "item"): # numpy
+            value = value.item()
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        normalised.append(value)
+    return json.dumps(normalised, ensure_ascii=False, separators=(",", ":"))
 
 class SketchpadTranslator:
+    """
+    Element properties go through TranslationContext.sv, so they can use
+    loop variables. Canvas properties are only set when they change, and
+    consecutive lines and rectangles in the same style are drawn as one
+    path. A sketchpad with no variables is static: with the context's
+    prerender_sketchpads option it is drawn once at startup and trials just
+    copy the result to the screen (see PRERENDER_JS).
+    """
     def __init__(self, _context, _elements):
         self.html = '<canvas id="sketchpad"></canvas>'
         self.context = _context
         self.elements = _elements
+        self.static = True
+        # statement drawing a static sketchpad at startup, if prerendered
+        self.prerender_js = None
+        # (AssetManifest method, arguments, URL) for each asset used, so
+        # they can be added again and checked unchanged if it is cached
+        self.assets = []
+
+    def uses_loop_tables(self):
+        """
+        True if the translation depends on the values in the loop tables,
+        not only on which variables there are
+        """
+        for el in self.elements:
+            if type(el).__name__ in ("gabor", "noise"):
+                return True
+            if type(el).__name__ == "image" and compile_text(
+                str(el.properties["file"]).strip()
+            ).variables:
+                return True
+        return False
 
     def to_js(self):
-        code = """\
-const canvas = document.getElementById("sketchpad");
-const ctx = canvas.getContext("2d");
-// defaults
-ctx.textAlign = "center";
-ctx.textBaseline = "middle";
-"""
+        """
+        Returns the code to draw the sketchpad once its HTML is shown, and
+        the HTML
+        """
+        self.static = True
+        self.prerender_js = None
+        self.assets = []
+        # canvas property: JS value, to skip setting things more than once
+        self._state = {}
+        # the path being built up, see add_to_path
+        self._path_key = None
+        self._path_style = None
+        self._path_segments = []
+        code = ""
         for el in self.elements:
-            if isinstance(el, arrow):
-                code += self.draw_arrow(el)
-            elif isinstance(el, circle):
-                code += self.draw_circle(el)
-            elif isinstance(el, ellipse):
-                code += self.draw_ellipse(el)
-            elif isinstance(el, fixdot):
-                code += self.draw_fixdot(el)
-            elif isinstance(el, gabor):
-                code += self.draw_gabor(el)
-            elif isinstance(el, image):
-                code += self.draw_image(el)
-            elif isinstance(el, line):
-                code += self.draw_line(el)
-            elif isinstance(el, noise):
-                code += self.draw_noise(el)
-            elif isinstance(el, rect):
-                code += self.draw_rect(el)
-            elif isinstance(el, textline):
-                code += self.draw_textline(el)
-            else:
+            # dispatch on class name (line, rect, textline, ...) so both the
+            # libopensesame and libqtopensesame elements are handled
+            draw = getattr(self, "draw_" + type(el).__name__, None)
+            if draw is None:
                 raise Exception(f"Unknown element type: {repr(type(el))}")
-        return code, self.html
+            code += draw(el)
+        code += self.flush_path()
+        if self.static and self.context.prerender_sketchpads:
+            key = hashlib.sha1(code.encode("utf-8")).hexdigest()[:12]
+            self.prerender_js = f"""\
+jspsych_prerender("{key}", function (canvas, ctx) {{
+{code}}});
+"""
+            return f'jspsych_blit("{key}");\n', self.html
+        return CANVAS_JS + DEFAULTS_JS + code, self.html
 
-    def set_colour(self, col):
-        return 'ctx.strokeStyle = "{col}";\n';
+    def expression(self, value):
+        """
+        JS for a property value, which may contain variables
+        """
+        text = str(value)
+        variables = compile_text(text.strip()).variables
+        if len(self.context.folded_values(variables)) < len(set(variables)):
+            self.static = False
+        return self.context.sv(text, auto_func=False)
 
-    def set_width(self, w):
-        return 'ctx.lineWidth = {w};\n'
+    def number(self, value):
+        if isinstance(value, (int, float)):
+            return repr(value)
+        return self.expression(value)
 
-    def set_size_and_font(self, size, font):
+    def set_state(self, **props):
+        """
+        Assigns canvas properties (e.g. lineWidth) to JS values, skipping
+        any already set to the same value
+        """
+        code = ""
+        for prop, value in props.items():
+            if self._state.get(prop) != value:
+                self._state[prop] = value
+                code += f"ctx.{prop} = {value};\n"
+        return code
+
+    def add_to_path(self, verb, style, segment):
+        """
+        Consecutive shapes drawn the same way (verb is "stroke" or "fill")
+        in the same style are drawn as a single path. Returns the code for
+        the previous path if this one can't be added to it.
+        """
+        key = (verb, tuple(sorted(style.items())))
+        code = ""
+        if key != self._path_key:
+            code = self.flush_path()
+            self._path_key = key
+            self._path_style = style
+        self._path_segments.append(segment)
+        return code
+
+    def flush_path(self):
+        """
+        Code to draw the path built up so far, if any
+        """
+        if self._path_key is None:
+            return ""
+        verb = self._path_key[0]
+        code = (
+            self.set_state(**self._path_style) +
+            "ctx.beginPath();\n" +
+            "".join(self._path_segments) +
+            f"ctx.{verb}();\n"
+        )
+        self._path_key = None
+        self._path_segments = []
+        return code
+
+    def font(self, size, font):
         # TODO: stack up fonts we need to retrieve from Google Fonts
         # (or similar, or self-hosted)
-        return 'ctx.font = "{size}px {font}";\n'
+        return self.expression(f"{size}px {font}")
 
     def draw_rect(self, rect):
-        code = self.set_colour(rect.color) + self.set_width(rect.penwidth)
-        if rect.fill:
-            verb = "fill"
-        else:
-            verb = "stroke"
-        code += "ctx.{verb}Rect({rect.x},{rect.y},{rect.w},{rect.h})"
-        return code
+        props = rect.properties
+        x, y, w, h = (self.number(props[key]) for key in ("x", "y", "w", "h"))
+        colour = self.expression(props["color"])
+        if props["fill"]:
+            return self.add_to_path(
+                "fill", {"fillStyle": colour}, f"ctx.rect({x},{y},{w},{h});\n"
+            )
+        return self.add_to_path(
+            "stroke",
+            {"strokeStyle": colour, "lineWidth": self.number(props["penwidth"])},
+            f"ctx.rect({x},{y},{w},{h});\n"
+        )
 
     def draw_line(self, line):
-        code = self.set_colour(line.color) + self.set_width(line.penwidth)
-        code += self.draw_polyline([(line.x1, line.y1), (line.x2, line.y2)])
-        return code
+        props = line.properties
+        style = {
+            "strokeStyle": self.expression(props["color"]),
+            "lineWidth": self.number(props["penwidth"]),
+        }
+        return self.draw_polyline(
+            [(props["x1"], props["y1"]), (props["x2"], props["y2"])], style
+        )
 
     def draw_textline(self, textline):
         props = textline.properties
-        code = (
-            self.set_colour(props["color"]) +
-            self.set_size_and_font(props["font_size"], props["font_family"])
+        # text is drawn straight away, so anything before it must be too
+        code = self.flush_path()
+        code += self.set_state(
+            fillStyle=self.expression(props["color"]),
+            font=self.font(props["font_size"], props["font_family"]),
+        )
+        text = self.expression(props["text"])
+        x, y = self.number(props["x"]), self.number(props["y"])
+        code += f'ctx.fillText({text},{x},{y});\n'
+        return code
+
+    def draw_image(self, image):
+        props = image.properties
+        src = self.image_src(
+            {"file": props["file"]},
+            lambda params: self.image_url(str(params["file"]))
+        )
+        scale = self.number(props.get("scale", 1))
+        x, y = self.number(props["x"]), self.number(props["y"])
+        code = self.flush_path()
+        code += f"""\
+{{
+    const img = jspsych_image({src});
+    const w = img.width * {scale}, h = img.height * {scale};
+"""
+        if props.get("center", 1):
+            code += f"    ctx.drawImage(img, {x} - w / 2, {y} - h / 2, w, h);\n}}\n"
+        else:
+            code += f"    ctx.drawImage(img, {x}, {y}, w, h);\n}}\n"
+        return code
+
+    def draw_gabor(self, gabor):
+        return self.draw_patch("gabor", gabor)
+
+    def draw_noise(self, noise):
+        return self.draw_patch("noise", noise)
+
+    def draw_patch(self, kind, element):
+        """
+        Gabor and noise patches are rendered to images now (see patches.py)
+        """
+        props = element.properties
+        src = self.image_src(
+            {name: props[name] for name in PATCH_PARAMS[kind]},
+            lambda params: self.patch_url(kind, params)
         )
-        code += 'ctx.fillText("{textline.text}");'
+        x, y = self.number(props["x"]), self.number(props["y"])
+        code = self.flush_path()
+        code += f"""\
+{{
+    const img = jspsych_image({src});
+    ctx.drawImage(img, {x} - img.width / 2, {y} - img.height / 2);
+}}
+"""
         return code
 
-    def draw_polyline(self, pts, close=False, fill=False):
-        if len(coords == 0):
+    def image_src(self, value_params, make_url):
+        """
+        JS for the URL of an image made by make_url from value_params
+        (name: property value). If the values use variables, an image is
+        made for every combination of values in the loop tables, and the
+        browser picks the right one.
+        """
+        # images may not have loaded by startup, so never prerender them
+        self.static = False
+        variables = []
+        for value in value_params.values():
+            # checks variables are registered
+            self.expression(value)
+            for varname in compile_text(str(value).strip()).variables:
+                if varname not in variables:
+                    variables.append(varname)
+        # with the optimize option, some have the same value in every row
+        folded = self.context.folded_values(variables)
+        variables = [varname for varname in variables if varname not in folded]
+        if not variables:
+            return json.dumps(make_url({
+                name: substitute(value, folded)
+                for name, value in value_params.items()
+            }))
+        urls = {}
+        for values in self.context.variable_values(variables):
+            values_by_name = dict(folded, **dict(zip(variables, values)))
+            urls[patch_key(values)] = make_url({
+                name: substitute(value, values_by_name)
+                for name, value in value_params.items()
+            })
+        key_js = ",".join(
+            f'jsPsych.timelineVariable("{varname}")' for varname in variables
+        )
+        return f"{json.dumps(urls)}[JSON.stringify([{key_js}])]"
+
+    def image_url(self, fname):
+        """
+        URL of an image in the file pool
+        """
+        path = fname if self.context.pool is None else self.context.pool[fname]
+        url = self.context.assets.add_file(path, fname)
+        self.assets.append(("add_file", (str(path), fname, "image"), url))
+        return url
+
+    def patch_url(self, kind, params):
+        params = {
+            name: PATCH_PARAM_TYPES.get(name, str)(value)
+            for name, value in params.items()
+        }
+        if kind == "noise":
+            # a fixed seed per set of parameters so the patch can be cached
+            params["seed"] = int(hashlib.sha1(
+                repr(sorted(params.items())).encode("utf-8")
+            ).hexdigest()[:8], 16)
+        content = self.context.patches.png(kind, **params)
+        name = f"{kind}.png"
+        url = self.context.assets.add_generated(name, content)
+        self.assets.append(("add_generated", (name, content, "image"), url))
+        return url
+
+    def draw_polyline(self, pts, style, close=False, fill=False):
+        """
+        style: canvas properties for add_to_path
+        """
+        if len(pts) == 0:
             return ""
-        code = "ctx.beginPath();\n"
-        code += "ctx.moveTo({pts[0][0]},{pts[0][1]});\n"
-        code += "\n".join(
-            'ctx.lineTo({pts[idx][0]},{pts[idx][1]});'
-            for idx in range(1,len(coords))
+        pts = [(self.number(x), self.number(y)) for x, y in pts]
+        segment = f"ctx.moveTo({pts[0][0]},{pts[0][1]});\n"
+        segment += "".join(
+            f'ctx.lineTo({pts[idx][0]},{pts[idx][1]});\n'
+            for idx in range(1,len(pts))
         )
         if close:
             # back to the start
-            code += 'ctx.lineTo({pts[0][0]},pts[0][1]);\n'
-        code += 'ctx.closePath();'
-        if fill:
-            code += 'ctx.fill();'
-        else:
-            code += 'ctx.stroke();'
-        return code
+            segment += 'ctx.closePath();\n'
+        return self.add_to_path("fill" if fill else "stroke", style, segment)
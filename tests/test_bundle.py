@@ -0,0 +1,38 @@
+"""
+minify_js on inputs where removing whitespace can change the meaning
+
+    python -m pytest tests
+"""
+
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bundle import minify_js
+
+def test_regex_and_division():
+    assert minify_js("a = b / c / d;") == "a=b/c/d;"
+    assert minify_js("x = (a + b) / 2;") == "x=(a+b)/2;"
+    assert minify_js("x = y.replace(/ +/g, ' ');") == "x=y.replace(/ +/g,' ');"
+    assert minify_js("return /a b/i.test(s);") == "return/a b/i.test(s);"
+
+def test_newlines_for_semicolon_insertion():
+    assert minify_js("a = 1\nb = 2") == "a=1\nb=2"
+    assert minify_js("a\n++b") == "a\n++b"
+    assert minify_js("f(a,\n  b)") == "f(a,b)"
+
+def test_operators_kept_apart():
+    assert minify_js("a = b + +c;") == "a=b+ +c;"
+    assert minify_js("a = b - -c;") == "a=b- -c;"
+    assert minify_js("a = b + -c;") == "a=b+-c;"
+
+def test_template_literals():
+    assert minify_js("s = `a  // b\n  c`;") == "s=`a  // b\n  c`;"
+    # left as it is inside ${}
+    assert minify_js("s = `x ${ a } y`;") == "s=`x ${ a } y`;"
+
+def test_number_then_member():
+    assert minify_js("var a = 1 .toString();") == "var a=1 .toString();"
+    assert minify_js("var a = 1.5 .toFixed(1);") == "var a=1.5 .toFixed(1);"
+    assert minify_js("var a = x .y;") == "var a=x.y;"
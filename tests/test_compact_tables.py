@@ -0,0 +1,32 @@
+"""
+The compact_tables option gives the same output, and with owns_experiment
+empties the experiment's loop tables as they are copied
+
+    python -m pytest tests
+"""
+
+from pathlib import Path
+import sys
+
+import pytest
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+sys.path.insert(0, str(HERE.parent / "benchmarks"))
+
+from generators import CASES
+from opensesame_to_jspsych import Convertor
+
+@pytest.mark.parametrize("case", CASES)
+def test_same_output(case):
+    generator, argument = CASES[case]
+    expected = Convertor(generator(min(argument, 300))).to_jspsych()
+    experiment = generator(min(argument, 300))
+    loops = [
+        item for item in experiment.items.values()
+        if type(item).__name__ == "loop"
+    ]
+    assert Convertor(
+        experiment, owns_experiment=True, compact_tables=True
+    ).to_jspsych() == expected
+    assert all(item.dm is None for item in loops)
@@ -0,0 +1,48 @@
+"""
+Loop repeat and cycles settings: fixed numbers are translated, a loop run 0
+times is left out, and anything else is reported with the loop's name
+
+    python -m pytest tests
+"""
+
+from pathlib import Path
+import sys
+
+import pytest
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+sys.path.insert(0, str(HERE.parent / "benchmarks"))
+
+from generators import trial_items
+from opensesame_to_jspsych import Convertor
+from standins import DataMatrix, Experiment, loop, sequence
+
+def looped(**var):
+    items = trial_items("trial")
+    trial_seq = sequence("trial_sequence", [(item.name, "always") for item in items])
+    block = loop("block_loop", trial_seq.name, DataMatrix({"x": [1, 2]}), **var)
+    seq = sequence("experiment", [(block.name, "always")])
+    return Experiment(items + [trial_seq, block, seq], "experiment")
+
+def test_repeat():
+    html, js = Convertor(looped(repeat=3)).to_jspsych()
+    assert "repetitions: 3" in js
+
+def test_cycles():
+    html, js = Convertor(looped(cycles=6)).to_jspsych()
+    assert "repetitions: 3" in js
+
+@pytest.mark.parametrize("var", [{"repeat": 0}, {"repeat": "0"}, {"cycles": 0}])
+def test_never_run(var):
+    html, js = Convertor(looped(**var)).to_jspsych()
+    assert "block_loop" not in js
+    assert "trial_sketchpad" not in js
+
+@pytest.mark.parametrize("var", [
+    {"repeat": "[reps]"}, {"repeat": "often"}, {"repeat": -1},
+    {"cycles": "[reps]"},
+])
+def test_invalid(var):
+    with pytest.raises(Exception, match="block_loop"):
+        Convertor(looped(**var)).to_jspsych()
@@ -0,0 +1,72 @@
+"""
+Translating again with a TranslationCache after an edit gives the same
+output as translating from scratch
+
+    python -m pytest tests
+"""
+
+from pathlib import Path
+import sys
+
+import pytest
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+sys.path.insert(0, str(HERE.parent / "benchmarks"))
+
+from generators import CASES
+from opensesame_to_jspsych import Convertor
+from translation_cache import TranslationCache, script_hashes
+
+OPTIONS = {
+    "default": {},
+    "columnar_tables": {"columnar_tables": True},
+    "external_tables": {"external_tables": True},
+    "optimize": {"optimize": True, "prerender_sketchpads": True},
+}
+
+def items_of_type(experiment, type_name):
+    return [
+        item for item in experiment.items.values()
+        if type(item).__name__ == type_name
+    ]
+
+def edit_sketchpad(experiment):
+    items = items_of_type(experiment, "sketchpad")
+    items[len(items) // 2].elements[0].properties["color"] = "blue"
+
+def edit_keyboard(experiment):
+    items = items_of_type(experiment, "keyboard_response")
+    items[len(items) // 2].var.allowed_responses = "z;m;space"
+
+def edit_table(experiment):
+    loops = items_of_type(experiment, "loop")
+    if loops:
+        dm = loops[-1].dm
+        colname = dm.column_names[0]
+        dm._columns[colname] = list(reversed(dm[colname]))
+
+def translate(experiment, options, cache=None):
+    item_hashes = None
+    if cache is not None:
+        item_hashes = script_hashes(experiment.to_string())
+    return Convertor(
+        experiment, cache=cache, item_hashes=item_hashes, **options
+    ).to_jspsych()
+
+@pytest.mark.parametrize("option_name", OPTIONS)
+@pytest.mark.parametrize("case", CASES)
+def test_edited_output_equals_fresh(case, option_name, tmp_path):
+    generator, argument = CASES[case]
+    experiment = generator(min(argument, 300))
+    options = dict(OPTIONS[option_name])
+    if options.get("external_tables"):
+        options["output_dir"] = tmp_path
+    cache = TranslationCache()
+    assert translate(experiment, options, cache) == translate(experiment, options)
+    for edit in (edit_sketchpad, edit_keyboard, edit_table):
+        edit(experiment)
+        assert (
+            translate(experiment, options, cache)
+            == translate(experiment, options)
+        )
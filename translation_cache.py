@@ -0,0 +1,96 @@
+# Lets repeated translations of the same experiment skip unchanged items
+
+from collections import OrderedDict
+import hashlib
+from pathlib import Path
+import pickle
+import re
+
+# starts an item's definition in an experiment script; the lines inside it
+# are indented
+_DEFINITION = re.compile(r"^define (\S+) (.+)$", re.M)
+
+def item_hash(item):
+    """
+    Stable hash of an OpenSesame item's type and script
+    """
+    text = f"{type(item).__name__}\n{item.to_string()}"
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def script_hashes(script):
+    """
+    item name: hash of the item's definition in an experiment script (as
+    experiment.to_string() gives, or an .osexp file holds), for the
+    item_hashes option. Serialising every item to hash it can take longer
+    than translating it; hashing the script an experiment was parsed from
+    doesn't.
+    """
+    hashes = {}
+    matches = list(_DEFINITION.finditer(script))
+    for idx, match in enumerate(matches):
+        end = matches[idx + 1].start() if idx + 1 < len(matches) else len(script)
+        name = match.group(2).strip().strip('"')
+        hashes[name] = hashlib.sha1(
+            script[match.start():end].encode("utf-8")
+        ).hexdigest()
+    return hashes
+
+class TranslationCache:
+    """
+    Least-recently-used store of translated fragments. Keys are tuples of
+    strings which include the hash of the item the fragment came from, so
+    entries never go stale -- an edited item just gets a new key.
+    Keep one instance between translations (the extension holds one for the
+    session). With cache_dir, entries are also pickled to disk so they
+    survive restarts; the directory is not pruned.
+    """
+    def __init__(self, max_entries=10000, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return self.cache_dir / f"{digest}.pickle"
+
+    def get(self, key):
+        """
+        The cached value, or None
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        if self.cache_dir is not None:
+            path = self._path(key)
+            if path.exists():
+                with open(path, "rb") as f:
+                    stored_key, value = pickle.load(f)
+                # guard against hash collisions
+                if stored_key == key:
+                    self._remember(key, value)
+                    self.hits += 1
+                    return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.cache_dir is not None:
+            with open(self._path(key), "wb") as f:
+                pickle.dump((key, value), f)
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0